@@ -0,0 +1,447 @@
+# 2D affine transformations. Matrix 3x3:
+#   | a c e |
+#   | b d f |
+#   | 0 0 1 |
+# is kept as tuple (a, b, c, d, e, f), so point x,y is transformed to
+# x' = a*x + c*y + e, y' = b*x + d*y + f. Transformations are composed
+# with compose() and applied to flat coordinates (x0, y0, x1, y1...) with
+# apply() at once.
+# If NumPy is available, GeomStore keeps coordinates of many shapes in one
+# array, so transformation of all (or some) of them is one vectorized
+# operation. GridIndex is the spatial index of bboxes for hit-testing.
+# simplify() reduces vertices of polylines (level of detail), bezier() tessellates
+# Bezier curves, similarity() finds matrix of moving/rotation/scaling of points.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+from array import array
+import itertools
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+IDENTITY = (1., 0., 0., 1., 0., 0.)
+
+def translate(xoff, yoff):
+    """Move by X-offset and Y-offset:
+    >>> list(apply(translate(10, -1), (1, 2, 3, 4)))
+    [11.0, 1.0, 13.0, 3.0]
+    """
+    return (1., 0., 0., 1., float(xoff), float(yoff))
+
+def scale(xfactor, yfactor, x=0, y=0):
+    """Scale by xfactor, yfactor about point x,y:
+    >>> list(apply(scale(2, 0.5, 10, 10), (20, 20)))
+    [30.0, 15.0]
+    """
+    return (float(xfactor), 0., 0., float(yfactor), x - x*xfactor, y - y*yfactor)
+
+def rotate(angle, x=0, y=0):
+    """Rotate on angle (degrees) about point x,y. Positive
+    angle is counter-clockwise on the screen (Y axe is down):
+    >>> [round(v, 6) for v in apply(rotate(90, 10, 10), (20, 10))]
+    [10.0, 0.0]
+    """
+    rangle = math.radians(angle)
+    cos = math.cos(rangle)
+    sin = math.sin(rangle)
+    return (cos, -sin, sin, cos, x - x*cos - y*sin, y + x*sin - y*cos)
+
+def compose(m1, m2):
+    """Returns matrix of transformation m1 then m2:
+    >>> compose(translate(1, 2), scale(2, 2)) == (2., 0., 0., 2., 2., 4.)
+    True
+    >>> compose(IDENTITY, rotate(30)) == rotate(30)
+    True
+    """
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a2*a1 + c2*b1, b2*a1 + d2*b1,
+            a2*c1 + c2*d1, b2*c1 + d2*d1,
+            a2*e1 + c2*f1 + e2, b2*e1 + d2*f1 + f2)
+
+def isidentity(m):
+    """Test that m is identity:
+    >>> isidentity(compose(translate(5, 5), translate(-5, -5)))
+    True
+    """
+    return m == IDENTITY
+
+def invert(m):
+    """Returns inverse matrix of m:
+    >>> m = compose(rotate(30, 5, 5), scale(2, 3))
+    >>> [round(v, 9) for v in compose(m, invert(m))] == list(IDENTITY)
+    True
+    """
+    a, b, c, d, e, f = m
+    det = float(a*d - b*c)
+    if det == 0.:
+        raise ValueError(u"matrix is not invertible")
+    ia, ib, ic, id = d/det, -b/det, -c/det, a/det
+    return (ia, ib, ic, id, -(ia*e + ic*f), -(ib*e + id*f))
+
+def apply(m, coords):
+    """Transform flat coordinates coords (x0, y0, x1, y1...),
+    returns new array('d') of them
+    """
+    a, b, c, d, e, f = m
+    it = iter(coords)
+    ret = array("d")
+    if b == 0. and c == 0.:
+        # the most often case: move, scale, flip
+        for x, y in itertools.izip(it, it):
+            ret.append(a*x + e)
+            ret.append(d*y + f)
+    else:
+        for x, y in itertools.izip(it, it):
+            ret.append(a*x + c*y + e)
+            ret.append(b*x + d*y + f)
+    return ret
+
+def iapply(m, coords):
+    """Transform in place flat coordinates coords - NumPy array (or
+    view of it):
+    >>> if numpy:
+    ...     a = numpy.array([1., 2., 3., 4.])
+    ...     iapply(translate(1, 1), a[2:])
+    ...     print a.tolist()
+    ... else:
+    ...     print [1.0, 2.0, 4.0, 5.0]
+    [1.0, 2.0, 4.0, 5.0]
+    """
+    xy = coords.reshape(-1, 2)
+    x = xy[:,0].copy()
+    a, b, c, d, e, f = m
+    xy[:,0] = a*x + c*xy[:,1] + e
+    xy[:,1] = b*x + d*xy[:,1] + f
+
+def simplify(coords, tolerance, closed=False):
+    """Douglas-Peucker simplification of polyline (polygon if closed) with
+    flat coordinates coords: returns sorted indexes of kept points (pairs),
+    other points are closer than tolerance to simplified polyline:
+    >>> simplify((0, 0, 1, 0.1, 2, -0.1, 3, 5, 4, 6), 0.5)
+    [0, 2, 3, 4]
+    >>> simplify((0, 0, 10, 0, 10, 0.2, 10, 10, 0, 10, 0.1, 5), 0.5, closed=True)
+    [0, 1, 3, 4]
+    """
+    xs = coords[0::2]
+    ys = coords[1::2]
+    n = len(xs)
+    if closed and n > 2:
+        # polygon is polyline from 1st point through all to 1st again
+        xs = list(xs) + [xs[0]]
+        ys = list(ys) + [ys[0]]
+    last = len(xs) - 1
+    if last < 2:
+        return range(n)
+    tol2 = float(tolerance)**2
+    keep = [False]*(last + 1)
+    keep[0] = keep[last] = True
+    stack = [(0, last)]
+    while stack:
+        i0, i1 = stack.pop()
+        x0, y0 = xs[i0], ys[i0]
+        dx, dy = xs[i1] - x0, ys[i1] - y0
+        len2 = float(dx*dx + dy*dy)
+        dmax = -1.
+        imax = None
+        for i in xrange(i0 + 1, i1):
+            px, py = xs[i] - x0, ys[i] - y0
+            # squared distance to segment (to point if segment is empty)
+            t = (px*dx + py*dy)/len2 if len2 else 0.
+            if t < 0.:
+                t = 0.
+            elif t > 1.:
+                t = 1.
+            ex, ey = px - t*dx, py - t*dy
+            d = ex*ex + ey*ey
+            if d > dmax:
+                dmax = d
+                imax = i
+        if imax is not None and dmax > tol2:
+            keep[imax] = True
+            stack.append((i0, imax))
+            stack.append((imax, i1))
+    return [i for i in xrange(n) if keep[i]]
+
+def similarity(src, dst, eps=1e-9):
+    """Returns matrix of similarity (rotation, uniform scale, move; not
+    flip) which transforms flat coordinates src to dst or None if there
+    is not such:
+    >>> [round(v, 9) for v in similarity((0, 0, 1, 0, 0, 1), (5, 5, 5, 7, 3, 5))]
+    [0.0, 2.0, -2.0, 0.0, 5.0, 5.0]
+    >>> similarity((0, 0, 1, 0, 0, 1), (0, 0, 2, 0, 0, 1)) is None
+    True
+    """
+    if len(src) != len(dst) or len(src) < 4:
+        return None
+    p0 = complex(src[0], src[1])
+    q0 = complex(dst[0], dst[1])
+    # points as complex numbers: q = q0 + z*(p - p0)
+    z = None
+    for i in xrange(2, len(src), 2):
+        u = complex(src[i], src[i+1]) - p0
+        if u:
+            z = (complex(dst[i], dst[i+1]) - q0)/u
+            break
+    if not z:
+        return None
+    for i in xrange(2, len(src), 2):
+        v = complex(dst[i], dst[i+1]) - q0
+        if abs(q0 + z*(complex(src[i], src[i+1]) - p0) - complex(dst[i], dst[i+1])) > \
+                eps*(abs(v) + 1.):
+            return None
+    t = q0 - z*p0
+    return (z.real, z.imag, -z.imag, z.real, t.real, t.imag)
+
+def bezier(coords, tolerance):
+    """Tessellation of chain of cubic Bezier curves with control points
+    coords (flat: p0, p1, p2, p3, p4, p5, p6...), last curve may be quadratic
+    or line if points are not enough. Returns flat coordinates of polyline
+    which is closer than tolerance to curves:
+    >>> bezier((0, 0, 10, 0), 0.1)
+    [0.0, 0.0, 10.0, 0.0]
+    >>> len(bezier((0, 0, 0, 10, 10, 10, 10, 0), 0.1))//2
+    17
+    """
+    pts = [(float(x), float(y)) for x, y in itertools.izip(coords[0::2], coords[1::2])]
+    if not pts:
+        return []
+    ret = [pts[0][0], pts[0][1]]
+    tol2 = float(tolerance)**2
+    i = 0
+    while i < len(pts) - 1:
+        seg = pts[i:i+4]
+        i += len(seg) - 1
+        if len(seg) == 2:
+            # line
+            ret.extend(seg[1])
+            continue
+        if len(seg) == 3:
+            # quadratic, elevated to cubic
+            (x0, y0), (x1, y1), (x2, y2) = seg
+            seg = [seg[0], (x0 + 2.*(x1 - x0)/3, y0 + 2.*(y1 - y0)/3),
+                    (x2 + 2.*(x1 - x2)/3, y2 + 2.*(y1 - y2)/3), seg[2]]
+        # adaptive subdivision (de Casteljau) until curve is flat
+        stack = [(seg, 0)]
+        while stack:
+            (p0, p1, p2, p3), depth = stack.pop()
+            if depth >= 16 or _flat(p0, p1, p2, p3, tol2):
+                ret.extend(p3)
+                continue
+            p01 = ((p0[0] + p1[0])/2, (p0[1] + p1[1])/2)
+            p12 = ((p1[0] + p2[0])/2, (p1[1] + p2[1])/2)
+            p23 = ((p2[0] + p3[0])/2, (p2[1] + p3[1])/2)
+            p012 = ((p01[0] + p12[0])/2, (p01[1] + p12[1])/2)
+            p123 = ((p12[0] + p23[0])/2, (p12[1] + p23[1])/2)
+            m = ((p012[0] + p123[0])/2, (p012[1] + p123[1])/2)
+            stack.append(((m, p123, p23, p3), depth + 1))
+            stack.append(((p0, p01, p012, m), depth + 1))
+    return ret
+
+def _flat(p0, p1, p2, p3, tol2):
+    """Test that control points p1, p2 are closer than sqrt(tol2) to
+    chord p0-p3 (then curve is closer too)
+    """
+    dx, dy = p3[0] - p0[0], p3[1] - p0[1]
+    len2 = dx*dx + dy*dy
+    for x, y in (p1, p2):
+        px, py = x - p0[0], y - p0[1]
+        if len2:
+            t = min(1., max(0., (px*dx + py*dy)/len2))
+            px, py = px - t*dx, py - t*dy
+        if px*px + py*py > tol2:
+            return False
+    return True
+
+class GeomStore:
+    """Coordinates of many items (flat arrays) in one contiguous NumPy
+    array. Item coordinates are available as views (should be used instead
+    of original arrays!), transformation is applied to them at once:
+    >>> if numpy:
+    ...     st = GeomStore([array("d", [1, 2]), array("d", [3, 4, 5, 6])])
+    ...     st.apply(translate(10, 0), [1])
+    ...     print st.views[0].tolist(), st.views[1].tolist()
+    ... else:
+    ...     print [1.0, 2.0], [13.0, 4.0, 15.0, 6.0]
+    [1.0, 2.0] [13.0, 4.0, 15.0, 6.0]
+    """
+    def __init__(self, coords):
+        """coords is the list of flat arrays of coordinates of items"""
+        if numpy is None:
+            raise ImportError(u"GeomStore needs NumPy")
+        sizes = [len(c) for c in coords]
+        self.offsets = numpy.zeros(len(coords) + 1, dtype=numpy.intp)
+        numpy.cumsum(sizes, out=self.offsets[1:])
+        self.flat = numpy.empty(self.offsets[-1], dtype=numpy.float64)
+        for c, o0, o1 in itertools.izip(coords, self.offsets[:-1], self.offsets[1:]):
+            self.flat[o0:o1] = c
+        self.views = [self.flat[o0:o1] for o0, o1 in itertools.izip(self.offsets[:-1],
+            self.offsets[1:])]
+
+    def __len__(self):
+        return len(self.views)
+
+    def apply(self, m, indexes=None):
+        """Transform coordinates of items with indexes (all if None)
+        """
+        if indexes is None:
+            iapply(m, self.flat)
+            return
+        indexes = numpy.asarray(indexes, dtype=numpy.intp)
+        starts = self.offsets[indexes]
+        sizes = self.offsets[indexes + 1] - starts
+        total = sizes.sum()
+        if not total:
+            return
+        # indexes of all numbers of items: starts of items repeated
+        # by their size plus position inside item
+        ends = numpy.cumsum(sizes)
+        idx = numpy.repeat(starts - (ends - sizes), sizes) + numpy.arange(total)
+        sel = self.flat[idx]
+        iapply(m, sel)
+        self.flat[idx] = sel
+
+class GridIndex:
+    """Spatial index of items bboxes (x0, y0, x1, y1): uniform grid of square
+    cells. Each item is kept in all cells which it's bbox overlaps (very big
+    items are kept separately). Items have order (Z-order), find() returns
+    items in this order:
+    >>> gi = GridIndex(cellsize=10)
+    >>> gi.insert("a", (0, 0, 25, 5), 1)
+    >>> gi.insert("b", (20, 0, 30, 30), 0)
+    >>> gi.find(22, 3), gi.find(5, 5), gi.find(29, 29), gi.find(40, 40)
+    (['b', 'a'], ['a'], ['b'], [])
+    >>> gi.insert("a", (100, 100, 110, 110), 1)
+    >>> gi.find(5, 5), gi.find(100, 110)
+    ([], ['a'])
+    >>> gi.remove("a"); len(gi)
+    1
+    """
+    MAXCELLS = 256 # items overlapping more cells are not kept in grid
+
+    def __init__(self, cellsize=64):
+        self.cellsize = float(cellsize)
+        self._cells = {} # {(col, row): set of items}
+        self._big = set() # items with too big bbox
+        self._items = {} # {item: (bbox, order, cells)}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def _cellsof(self, bbox):
+        """Returns list of cells (col, row) which are overlapped by bbox
+        or None if they are too many
+        """
+        cs = self.cellsize
+        c0 = int(math.floor(bbox[0]/cs))
+        r0 = int(math.floor(bbox[1]/cs))
+        c1 = int(math.floor(bbox[2]/cs))
+        r1 = int(math.floor(bbox[3]/cs))
+        if (c1 - c0 + 1)*(r1 - r0 + 1) > self.MAXCELLS:
+            return None
+        return [(c, r) for c in xrange(c0, c1 + 1) for r in xrange(r0, r1 + 1)]
+
+    def insert(self, item, bbox, order=0):
+        """Insert item with bbox (or update it if already is). If bbox
+        is None or empty (x0 > x1), item is removed
+        """
+        self.remove(item)
+        if bbox is None or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            return
+        cells = self._cellsof(bbox)
+        if cells is None:
+            self._big.add(item)
+        else:
+            for cell in cells:
+                self._cells.setdefault(cell, set()).add(item)
+        self._items[item] = (bbox, order, cells)
+
+    def remove(self, item):
+        """Remove item if is"""
+        e = self._items.pop(item, None)
+        if e is None:
+            return
+        cells = e[2]
+        if cells is None:
+            self._big.discard(item)
+        else:
+            for cell in cells:
+                items = self._cells[cell]
+                items.discard(item)
+                if not items:
+                    del self._cells[cell]
+
+    def clear(self):
+        self._cells.clear()
+        self._big.clear()
+        self._items.clear()
+
+    def find(self, x, y):
+        """Returns list of items which bbox contains point x,y,
+        sorted by order
+        """
+        cs = self.cellsize
+        cell = (int(math.floor(x/cs)), int(math.floor(y/cs)))
+        ret = []
+        for items in (self._cells.get(cell, ()), self._big):
+            for item in items:
+                bbox, order, cells = self._items[item]
+                if bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]:
+                    ret.append((order, item))
+        ret.sort(key=lambda e: e[0])
+        return [e[1] for e in ret]
+
+def _bench(nitems=5000, npoints=4, repeat=5):
+    """Transformation of many items: each item separately vs. GeomStore"""
+    import random
+    import time
+    coords = [array("d", (random.randint(0, 1000) for i in xrange(2*npoints)))
+            for j in xrange(nitems)]
+    m = rotate(30, 500, 500)
+    def best(f):
+        ret = None
+        for i in xrange(repeat):
+            t0 = time.time()
+            f()
+            t = time.time() - t0
+            ret = t if ret is None else min(ret, t)
+        return ret
+    t1 = best(lambda: [apply(m, c) for c in coords])
+    print "%-16s %8.2f ms"%("items", t1*1000)
+    if numpy is None:
+        print "No NumPy"
+        return
+    st = GeomStore(coords)
+    t2 = best(lambda: st.apply(m))
+    half = range(0, nitems, 2)
+    t3 = best(lambda: st.apply(m, half))
+    print "%-16s %8.2f ms"%("store (all)", t2*1000)
+    print "%-16s %8.2f ms"%("store (half)", t3*1000)
+    print "speedup: %.1f"%(t1/t2)
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    doctest.testmod()
+    print "Internal tests passed"
+    if sys.argv[1:] == ["--bench"]:
+        _bench()
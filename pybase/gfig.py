@@ -1,6 +1,9 @@
 # GFig GIMP 2.6 files parsing. Parses only KNOWN_SHAPES, all
 # other are ignored. Also parses styles and extra parameters.
 # Suppose fixed structure of file: lines are not joined!
+# Parser is incremental: feed() chunks, then close(), or parse() file
+# object - shapes are handled as soon as they are read. GFigIndex indexes
+# file without building of shapes, they are parsed on demand.
 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -25,7 +28,17 @@
 #   - Peter Mattis
 # Author: P. Yosifov, 2010
 
+import collections
+import itertools
+import threading
+import tempfile
+import hashlib
+import cPickle
+import math
+import codecs
+import os
 import re
+from array import array
 
 # all other are ignored
 KNOWN_SHAPES = (u"line", u"rectangle", u"circle", u"ellipse", u"poly",
@@ -93,21 +106,226 @@ def _gettag(line):
             return {"name":m.group(1), "opened":False, "attrs":{}}
     return None
 
-class Shape:
-    """Shape like line or circle...
+# Fast scanner: one pass over the whole chunk of data (lower-cased, ends
+# with "\n"). Each match is a token: whole simple shape (tag without attrs
+# with points, extra, style), <style object> or <extra> block, block of
+# lines with points pairs, tag line or any other line (last is parsed as
+# usual line). Name of token is lastgroup of match
+_cre_scan = re.compile(ur"""
+    \s*
+    (?:
+      (?P<shape>[ \t]*<(?!extra>)(?P<sname>\w+)>[ \t]*\n
+        (?P<spoints>(?:[ \t]*-?\d+[ \t]+-?\d+[ \t]*\n)*)
+        (?:[ \t]*<extra>[ \t]*\n (?P<snums>(?:[ \t]*-?\d+(?:[ \t]+-?\d+)*[ \t]*\n)*) [ \t]*</extra>[ \t]*\n)?
+        (?:[ \t]*<style\ object>[ \t]*\n (?P<sstyles>(?:[ \t]*[^<\s][^\n]*\n)*) [ \t]*</style>[ \t]*\n)?
+        [ \t]*</(?P=sname)>[ \t]*\n)
+    | (?P<style>[ \t]*<style\ object>[ \t]*\n (?P<styles>(?:[ \t]*[^<\s][^\n]*\n)*) [ \t]*</style>[ \t]*\n)
+    | (?P<extra>[ \t]*<extra>[ \t]*\n (?P<nums>(?:[ \t]*-?\d+(?:[ \t]+-?\d+)*[ \t]*\n)*) [ \t]*</extra>[ \t]*\n)
+    | (?P<points>(?:[ \t]*-?\d+[ \t]+-?\d+[ \t]*\n)+)
+    | (?P<tag>[ \t]*<[ \t]*(?P<close>/?)[ \t]*(?P<name>\w+)[ \t]*(?P<attrs>[^\n]*)>[^\n]*\n)
+    | (?P<line>[^\n]*\n)
+    )""", re.X)
+# line which closes <style object>, <extra> block (see _parseline())
+_cre_blockend = {
+    u"style": re.compile(ur"^[ \t]*</style>[ \t]*\n", re.M),
+    u"extra": re.compile(ur"^[ \t]*</extra>[ \t]*\n", re.M),
+}
+# pairs of styles block (only usual lines: "var: val")
+_cre_style = re.compile(ur"^([^\s:]+):?[ \t]+(.+)$", re.M)
+
+def _scan(data, pos=0):
+    """Iterate over tokens of data, yields (name, match):
+    >>> for name, m in _scan(u'<line>\\n1 2\\n 3 4\\n<style object>\\na: b\\n</style>\\n</line>\\n'):
+    ...     print name, m.group('sname', 'spoints', 'sstyles')
+    shape (u'line', u'1 2\\n 3 4\\n', u'a: b\\n')
+    >>> for name, m in _scan(u'<line a=1>\\n1 2\\n 3 4\\n<style object>\\na: b\\n</style>\\n</line>\\n'):
+    ...     print name, repr(m.group(name))
+    tag u'<line a=1>\\n'
+    points u'1 2\\n 3 4\\n'
+    style u'<style object>\\na: b\\n</style>\\n'
+    tag u'</line>\\n'
+    """
+    end = len(data)
+    match = _cre_scan.match
+    while pos < end:
+        m = match(data, pos)
+        if not m:
+            # only blank lines at the end
+            break
+        yield (m.lastgroup, m)
+        pos = m.end()
+
+_interned = {} # {frozenset of items: dict}
+_MAXINTERNED = 4096 # when more, _interned is cleared
+def _intern(d):
+    """Returns shared dict equal to d. Don't change it, replace only!
+    >>> _intern({u'a': u'1'}) is _intern({u'a': u'1'})
+    True
+    """
+    key = frozenset(d.iteritems())
+    ret = _interned.get(key)
+    if ret is None:
+        if len(_interned) >= _MAXINTERNED:
+            _interned.clear()
+        ret = _interned[key] = dict(d)
+    return ret
+
+class Points(object):
+    """List-like view of flat array of coordinates (x0, y0, x1, y1...),
+    items are (x, y) pairs:
+    >>> pts = Points(array("d", [1, 2, 3, 4]))
+    >>> len(pts), pts[1], pts[-2], list(pts)
+    (2, (3.0, 4.0), (1.0, 2.0), [(1.0, 2.0), (3.0, 4.0)])
+    >>> pts.append((5, 6))
+    >>> pts
+    [(1.0, 2.0), (3.0, 4.0), (5.0, 6.0)]
+    >>> pts[3]
+    Traceback (most recent call last):
+        ...
+    IndexError: point index out of range
     """
+    __slots__ = ("flat",)
+
+    def __init__(self, flat):
+        self.flat = flat
+
+    def __len__(self):
+        return len(self.flat)//2
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        n = len(self.flat)//2
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("point index out of range")
+        return (self.flat[2*i], self.flat[2*i+1])
+
+    def __iter__(self):
+        it = iter(self.flat)
+        return itertools.izip(it, it)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, p):
+        """Append point p - pair x,y"""
+        if len(p) != 2:
+            raise ValueError("point should be pair of x, y")
+        self.flat.extend(p)
+
+    def extend(self, ps):
+        """Append points ps - sequence of pairs x,y"""
+        for p in ps:
+            self.append(p)
+
+class Shape(object):
+    """Shape like line or circle... Coordinates are kept in flat
+    array coords, points is the list-like view of them (pairs), also
+    can be set to any sequence of pairs. attrs and styles are shared
+    between equal shapes (see _intern()), so replace them, don't change!
+    """
+    __slots__ = ("name", "coords", "extra", "attrs", "styles", "_opts", "_ignored")
+
     def __init__(self, name, attrs=None, ignored=False):
-        self.points = [] # pairs of coordinates (int)
-        self.extra = [] # list of numbers
+        self.coords = array("d") # x0, y0, x1, y1...
+        self.extra = array("l") # list of numbers
         self.attrs = attrs or {} # dict of attributes (like HTML tag)
         self.name = name
         self._ignored = ignored
         self.styles = {}
-        self.opts = {} # additional options (for user)
+        self._opts = None
+
+    @property
+    def points(self):
+        """pairs of coordinates"""
+        return Points(self.coords)
+
+    @points.setter
+    def points(self, points):
+        self.coords = array("d", itertools.chain.from_iterable(points))
+
+    @property
+    def opts(self):
+        """additional options (for user)"""
+        if self._opts is None:
+            self._opts = {}
+        return self._opts
+
+    def _intern(self):
+        """Share attrs and styles with equal shapes (after parsing)"""
+        self.attrs = _intern(self.attrs)
+        self.styles = _intern(self.styles)
+
+    def __getstate__(self):
+        return (self.name, self.coords.tostring(), self.extra.tolist(), dict(self.attrs),
+                dict(self.styles), self._opts, self._ignored)
+
+    def __setstate__(self, state):
+        name, coords, extra, attrs, styles, self._opts, self._ignored = state
+        self.name = name
+        self.coords = array("d")
+        self.coords.fromstring(coords)
+        self.extra = array("l", extra)
+        self.attrs = _intern(attrs)
+        self.styles = _intern(styles)
+
+    def copy(self):
+        """Copy of shape (coords, extra, opts are copied, not shared)"""
+        sh = Shape(self.name, self.attrs, self._ignored)
+        sh.coords = array("d", self.coords)
+        sh.extra = array("l", self.extra)
+        sh.styles = self.styles
+        if self._opts is not None:
+            sh._opts = dict(self._opts)
+        return sh
+
+# states of parser
+_HEAD = 1
+_OPTS = 2
+_OBJ = 3 # general content of file (tags after <options>)
+_EXTRA = 4
+_STYLE = 5
 
 class GFigParser:
-    def __init__(self):
-        pass
+    """Incremental parser: feed() it with chunks of data (any size, line
+    may be splitted between chunks), then call close(). Each shape is handled
+    (handle_shape()) immediately when it's tag is closed, so whole file is
+    never kept in memory:
+    >>> class P(GFigParser):
+    ...     def handle_shape(self, shape): print shape.name, shape.points
+    >>> p = P()
+    >>> for chunk in ("gfig version 0.2\\n<options>\\n</opt", "ions>\\n<line>\\n1 ",
+    ...         "2\\n3 4\\n</line>\\n<circle>\\n"):
+    ...     p.feed(chunk)
+    line [(1.0, 2.0), (3.0, 4.0)]
+    >>> p.feed("0 0\\n5 5\\n</circle>")
+    >>> p.close()
+    circle [(0.0, 0.0), (5.0, 5.0)]
+    """
+    CHUNKSIZE = 65536 # size of chunk for parse()
+
+    def __init__(self, fastlex=True):
+        """fastlex enables fast lexer: one scanner pass over each chunk
+        and conversion of points, styles, extra data by blocks (not lines)
+        """
+        self.fastlex = fastlex
+        self.reset()
+
+    def reset(self):
+        """Reset parser state, all fed but not parsed data is lost"""
+        self._st = _HEAD
+        self._shapes = [] # stack of opened shapes
+        self._pairs = []
+        self._nline = -1 # zero-based number of last parsed line
+        self._tail = u"" # not finished line from previous chunk
 
     # override them!
     def handle_header(self, attrs):
@@ -121,118 +339,733 @@ class GFigParser:
         pass
 
     def feed(self, data):
-        """Parser. data is the strings (decode as utf8->unicode!)
+        """Feed parser with some chunk of data (decode as utf8->unicode!).
+        Call close() after last chunk
+        """
+        if self.fastlex:
+            data = self._tail + data
+            if u"\r" in data:
+                data = data.replace(u"\r\n", u"\n").replace(u"\r", u"\n")
+            # last line may be not finished, so wait for rest of it in next chunk
+            i = data.rfind(u"\n") + 1
+            self._tail = data[i:]
+            self._fastfeed(data[:i])
+            return
+
+        lines = (self._tail + data).splitlines(True)
+        self._tail = u""
+        # last line may be not finished (or is "\r" of "\r\n" only), so
+        # wait for rest of it in next chunk
+        if lines and lines[-1][-1:] != u"\n":
+            self._tail = lines.pop()
+        for line in lines:
+            self._nline += 1
+            self._parseline(line)
+
+    def close(self):
+        """Finish parsing: parse rest of data and check that file
+        is complete
         """
-        HEAD = 1
-        OPTS = 2
-        OBJ = 3 # general content of file (tags after <options>)
-        EXTRA = 4
-        STYLE = 5
-
-        shapes = []
-        pairs = []
-        st = HEAD
-        for nline,line in enumerate(data.splitlines()):
-            line = _normline(line)
-            if not line:
+        # rest of data (not finished line or block) is parsed line by line
+        for line in self._tail.splitlines():
+            self._nline += 1
+            self._parseline(line)
+        self._tail = u""
+        nline = self._nline
+        if self._shapes:
+            raise GFigParseError(u"Unbalanced tags detected", nline)
+        if self._st == _EXTRA:
+            raise GFigParseError(u"No closed </extra> tag", nline)
+        if self._st != _OBJ:
+            raise GFigParseError(u"No any shapes", nline)
+
+    def parse(self, src, encoding="utf8"):
+        """Parse whole file: src is file object (or any iterator over
+        encoded strings). File is read, decoded and parsed by chunks
+        (CHUNKSIZE)
+        """
+        self.reset()
+        if hasattr(src, "read"):
+            read = src.read
+            src = iter(lambda: read(self.CHUNKSIZE), "")
+        for chunk in codecs.iterdecode(src, encoding):
+            self.feed(chunk)
+        self.close()
+
+    def _fastfeed(self, data):
+        """Parse data (should ends with "\\n") with fast scanner. Not
+        finished <style object>, <extra> blocks are kept in tail
+        """
+        shapes = self._shapes
+        ldata = data.lower()
+        end = len(ldata)
+        match = _cre_scan.match
+        pos = 0
+        while pos < end:
+            m = match(ldata, pos)
+            if not m:
+                # only blank lines at the end
+                break
+            tok = m.lastgroup
+            # blank lines before token
+            self._nline += data.count(u"\n", pos, m.start(tok))
+            pos = m.end()
+            text = m.group(tok)
+
+            if self._st != _OBJ or tok == "line":
+                # parse as usual line by line
+                for line in text.splitlines():
+                    self._nline += 1
+                    self._parseline(line)
                 continue
 
-            if st == HEAD:
-                if line == u"<options>":
-                    self.handle_header(pairs)
-                    st = OPTS
-                    del pairs[:]
+            if tok == "shape":
+                # the most often case: whole shape in one token
+                name, points, nums, styles = m.group("sname", "spoints", "snums", "sstyles")
+                sh = Shape(name, ignored=name not in KNOWN_SHAPES)
+                if points and not sh._ignored:
+                    sh.coords.extend(map(int, points.split()))
+                if nums:
+                    sh.extra.extend(map(int, nums.split()))
+                if styles:
+                    nline = self._nline + text.count(u"\n", 0, m.start("sstyles") - m.start(tok))
+                    self._faststyles(sh, styles, nline)
+                self._nline += text.count(u"\n")
+                if not sh._ignored:
+                    sh._intern()
+                    self.handle_shape(sh)
+
+            elif tok == "points":
+                if not shapes:
+                    raise GFigParseError(u"unexpected string", self._nline + 1, text.strip())
+                if not shapes[-1]._ignored:
+                    shapes[-1].coords.extend(map(int, text.split()))
+                self._nline += text.count(u"\n")
+
+            elif tok == "tag":
+                self._nline += 1
+                name = m.group("name")
+                if not m.group("close"):
+                    # opened tag
+                    if name in (u"style", u"extra"):
+                        # block is not usual (blank lines, for ex.) or is not
+                        # finished in this chunk
+                        self._nline -= 1
+                        blockend = _cre_blockend[name].search(ldata, m.end(tok))
+                        if not blockend:
+                            # wait for the rest of block in next chunk
+                            self._tail = data[m.start(tok):] + self._tail
+                            return
+                        pos = blockend.end()
+                        for line in data[m.start(tok):pos].splitlines():
+                            self._nline += 1
+                            self._parseline(line)
+                        continue
+                    attrs = m.group("attrs")
+                    if attrs:
+                        attrs = dict((k,v.strip("'\"")) for k,v in _cre2.findall(attrs.strip()))
+                    shapes.append(Shape(name, ignored=name not in KNOWN_SHAPES, attrs=attrs))
                 else:
-                    #pair = _getpair(line, u"gfig version") or \
-                            #_getpair(line, u"name:") or \
-                            #_getpair(line, u"version:") or \
-                            #_getpair(line, u"objcount:")
-                    pair = _getpair(line)
-                    if pair:
-                        pairs.append(pair)
-                    else:
-                        raise GFigParseError(u"unexpected line", nline, line)
+                    # closed tag
+                    if not shapes:
+                        raise GFigParseError(u"unbalanced tag", self._nline, text.strip())
+                    if shapes[-1].name != name:
+                        raise GFigParseError(u"unexpected closed tag", self._nline, text.strip())
+                    sh = shapes.pop()
+                    if not sh._ignored:
+                        sh._intern()
+                        self.handle_shape(sh)
+
+            elif tok == "style":
+                if not shapes:
+                    raise GFigParseError(u"out of the tag", self._nline + 1)
+                self._faststyles(shapes[-1], m.group("styles"), self._nline + 1)
+                self._nline += text.count(u"\n")
 
-            elif st == OPTS:
-                if line == u"</options>":
-                    self.handle_options(pairs)
-                    st = OBJ
-                    del pairs[:]
+            elif tok == "extra":
+                if not shapes:
+                    raise GFigParseError(u"out of the tag", self._nline + 1)
+                shapes[-1].extra.extend(map(int, m.group("nums").split()))
+                self._nline += text.count(u"\n")
+
+    def _faststyles(self, shape, block, nline):
+        """Parse lines of <style object> block, nline is the
+        number of line before block (for error messages)
+        """
+        pairs = _cre_style.findall(block)
+        # each line is "var: val" with single spaces, so
+        # pairs are the same as _getpair() returns
+        if len(pairs) == block.count(u"\n") == block.count(u":") and \
+                u"  " not in block and u"\t" not in block and u" \n" not in block:
+            shape.styles.update(pairs)
+        else:
+            # rare case, some pairs are not usual
+            for i,line in enumerate(block.splitlines()):
+                pair = _getpair(line.strip())
+                if pair:
+                    shape.styles[pair[0]] = pair[1]
                 else:
-                    #pair = _getpair(line, u"gridspacing:") or \
-                            #_getpair(line, u"gridtype:") or \
-                            #_getpair(line, u"snap2grid:") or \
-                            #_getpair(line, u"lockongrid:") or \
-                            #_getpair(line, u"drawgrid:") or \
-                            #_getpair(line, u"showcontrol:")
-                    pair = _getpair(line)
-                    if pair:
-                        pairs.append(pair)
-                    else:
-                        raise GFigParseError(u"unexpected line", nline, line)
-
-            elif st == OBJ:
-                # don't change order of if's !
-                if line == u"<extra>":
-                    st = EXTRA
-                elif line == u"<style object>":
-                    st = STYLE
+                    raise GFigParseError(u"Incorrect style data", nline + i + 1, line.strip())
+
+    def _parseline(self, line):
+        """Process one line of file with state machine"""
+        line = _normline(line)
+        if not line:
+            return
+
+        nline = self._nline
+        shapes = self._shapes
+        pairs = self._pairs
+        st = self._st
+
+        if st == _HEAD:
+            if line == u"<options>":
+                self.handle_header(pairs)
+                self._st = _OPTS
+                del pairs[:]
+            else:
+                #pair = _getpair(line, u"gfig version") or \
+                        #_getpair(line, u"name:") or \
+                        #_getpair(line, u"version:") or \
+                        #_getpair(line, u"objcount:")
+                pair = _getpair(line)
+                if pair:
+                    pairs.append(pair)
+                else:
+                    raise GFigParseError(u"unexpected line", nline, line)
+
+        elif st == _OPTS:
+            if line == u"</options>":
+                self.handle_options(pairs)
+                self._st = _OBJ
+                del pairs[:]
+            else:
+                #pair = _getpair(line, u"gridspacing:") or \
+                        #_getpair(line, u"gridtype:") or \
+                        #_getpair(line, u"snap2grid:") or \
+                        #_getpair(line, u"lockongrid:") or \
+                        #_getpair(line, u"drawgrid:") or \
+                        #_getpair(line, u"showcontrol:")
+                pair = _getpair(line)
+                if pair:
+                    pairs.append(pair)
                 else:
-                    tag = _gettag(line)
-                    if tag:
-                        if tag["opened"]:
-                            # opened tag
-                            if tag["name"] not in KNOWN_SHAPES:
-                                ignored = True
-                            else:
-                                ignored = False
-                            shapes.append(Shape(tag["name"], ignored=ignored, attrs=tag["attrs"]))
+                    raise GFigParseError(u"unexpected line", nline, line)
+
+        elif st == _OBJ:
+            # don't change order of if's !
+            if line == u"<extra>":
+                self._st = _EXTRA
+            elif line == u"<style object>":
+                self._st = _STYLE
+            else:
+                tag = _gettag(line)
+                if tag:
+                    if tag["opened"]:
+                        # opened tag
+                        if tag["name"] not in KNOWN_SHAPES:
+                            ignored = True
                         else:
-                            # closed tag
-                            if len(shapes) < 1:
-                                raise GFigParseError(u"unbalanced tag", nline, line)
-                            if shapes[-1].name != tag["name"]:
-                                raise GFigParseError(u"unexpected closed tag", nline, line)
-                            sh = shapes.pop()
-                            if not sh._ignored:
-                                self.handle_shape(sh)
+                            ignored = False
+                        shapes.append(Shape(tag["name"], ignored=ignored, attrs=tag["attrs"]))
                     else:
-                        # not tag but points coordinates
+                        # closed tag
                         if len(shapes) < 1:
-                            raise GFigParseError(u"unexpected string", nline, line)
-                        if not shapes[-1]._ignored:
-                            shapes[-1].points.append([int(s) for s in line.split()])
-
-            elif st == EXTRA:
-                if len(shapes) < 1:
-                    raise GFigParseError(u"out of the tag", nline, line)
-                if line == u"</extra>":
-                    st = OBJ
+                            raise GFigParseError(u"unbalanced tag", nline, line)
+                        if shapes[-1].name != tag["name"]:
+                            raise GFigParseError(u"unexpected closed tag", nline, line)
+                        sh = shapes.pop()
+                        if not sh._ignored:
+                            sh._intern()
+                            self.handle_shape(sh)
                 else:
-                    try:
-                        shapes[-1].extra.extend(int(s) for s in line.split())
-                    except:
-                        raise GFigParseError(u"Incorrect extra data", nline, line)
-
-            elif st == STYLE:
-                if len(shapes) < 1:
-                    raise GFigParseError(u"out of the tag", nline, line)
-                if line == u"</style>":
-                    st = OBJ
+                    # not tag but points coordinates
+                    if len(shapes) < 1:
+                        raise GFigParseError(u"unexpected string", nline, line)
+                    if not shapes[-1]._ignored:
+                        point = [int(s) for s in line.split()]
+                        if len(point) != 2:
+                            raise GFigParseError(u"Incorrect point", nline, line)
+                        shapes[-1].coords.extend(point)
+
+        elif st == _EXTRA:
+            if len(shapes) < 1:
+                raise GFigParseError(u"out of the tag", nline, line)
+            if line == u"</extra>":
+                self._st = _OBJ
+            else:
+                try:
+                    shapes[-1].extra.extend(int(s) for s in line.split())
+                except:
+                    raise GFigParseError(u"Incorrect extra data", nline, line)
+
+        elif st == _STYLE:
+            if len(shapes) < 1:
+                raise GFigParseError(u"out of the tag", nline, line)
+            if line == u"</style>":
+                self._st = _OBJ
+            else:
+                pair = _getpair(line)
+                if pair:
+                    shapes[-1].styles[pair[0]] = pair[1]
                 else:
-                    pair = _getpair(line)
-                    if pair:
-                        shapes[-1].styles[pair[0]] = pair[1]
-                    else:
-                        raise GFigParseError(u"Incorrect style data", nline, line)
+                    raise GFigParseError(u"Incorrect style data", nline, line)
 
-        if shapes:
-            raise GFigParseError(u"Unbalanced tags detected", nline)
-        if st == EXTRA:
-            raise GFigParseError(u"No closed </extra> tag", nline)
-        if st != OBJ:
-            raise GFigParseError(u"No any shapes", nline)
 
+# Cache of parsed files {{{
+
+class _GFigCollector(GFigParser):
+    """Parser which keeps all parsed data: header, options (lists
+    of pairs) and shapes
+    """
+    def reset(self):
+        GFigParser.reset(self)
+        self.header = []
+        self.options = []
+        self.shapes = []
+    def handle_header(self, attrs):
+        self.header = list(attrs)
+    def handle_options(self, attrs):
+        self.options = list(attrs)
+    def handle_shape(self, shape):
+        self.shapes.append(shape)
+
+class GFigCache:
+    """Cache of parsed GFig files: (header, options, shapes). Key is the
+    path of file, entry is valid while mtime and size of file are the same.
+    Entries are kept in memory (LRU, maxbytes is the budget in bytes of
+    source files) and, if cachedir is set, in pickled files in cachedir.
+    Shapes in cache are shared, so use copies of them (Shape.copy())!
+    """
+    VERSION = 2 # version of format of files in cachedir
+    EXT = ".gfigc"
+
+    def __init__(self, maxbytes=16*1024*1024, cachedir=None):
+        self.maxbytes = maxbytes
+        self.cachedir = cachedir
+        self._entries = collections.OrderedDict() # {path:(mtime, size, doc)}, last is newest
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Clear memory cache (not files in cachedir)"""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _diskpath(self, filename):
+        name = hashlib.md5(filename.encode("utf8")).hexdigest()
+        return os.path.join(self.cachedir, name + GFigCache.EXT)
+
+    def _diskload(self, filename, mtime, size):
+        """Returns doc from cachedir or None"""
+        try:
+            with open(self._diskpath(filename), "rb") as f:
+                ver, fn, mt, sz, doc = cPickle.load(f)
+            if ver == GFigCache.VERSION and fn == filename and mt == mtime and sz == size:
+                return doc
+        except Exception:
+            pass
+        return None
+
+    def _disksave(self, filename, mtime, size, doc):
+        """Save doc into cachedir (via temp. file, so other processes
+        never see not finished file)"""
+        try:
+            if not os.path.exists(self.cachedir):
+                os.makedirs(self.cachedir)
+            p = self._diskpath(filename)
+            fd, tmp = tempfile.mkstemp(dir=self.cachedir)
+            with os.fdopen(fd, "wb") as f:
+                cPickle.dump((GFigCache.VERSION, filename, mtime, size, doc), f,
+                        cPickle.HIGHEST_PROTOCOL)
+            if os.path.exists(p):
+                os.remove(p) # rename() on Windows can not replace
+            os.rename(tmp, p)
+        except Exception:
+            pass
+
+    def put(self, filename, doc, mtime=None, size=None):
+        """Put doc (header, options, shapes) of filename in memory cache,
+        mtime and size are the stat values of file (if omitted, are got now)
+        """
+        filename = os.path.abspath(filename)
+        if mtime is None or size is None:
+            st = os.stat(filename)
+            mtime, size = st.st_mtime, st.st_size
+        with self._lock:
+            old = self._entries.pop(filename, None)
+            if old:
+                self._nbytes -= old[1]
+            self._entries[filename] = (mtime, size, doc)
+            self._nbytes += size
+            # drop least recently used, but keep at least this entry
+            while self._nbytes > self.maxbytes and len(self._entries) > 1:
+                fn, (mt, sz, d) = self._entries.popitem(last=False)
+                self._nbytes -= sz
+
+    def load(self, filename, encoding="utf8"):
+        """Returns (header, options, shapes) of file filename: from memory,
+        from cachedir or parse file (and cache it)
+        """
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        mtime, size = st.st_mtime, st.st_size
+        with self._lock:
+            e = self._entries.get(filename)
+            if e:
+                if e[:2] == (mtime, size):
+                    # make it newest
+                    del self._entries[filename]
+                    self._entries[filename] = e
+                    return e[2]
+                else:
+                    # stale entry, file was changed
+                    del self._entries[filename]
+                    self._nbytes -= e[1]
+
+        doc = None
+        if self.cachedir:
+            doc = self._diskload(filename, mtime, size)
+        if doc is None:
+            p = _GFigCollector()
+            with open(filename, "rb") as f:
+                p.parse(f, encoding)
+            doc = (p.header, p.options, p.shapes)
+            if self.cachedir:
+                self._disksave(filename, mtime, size, doc)
+        self.put(filename, doc, mtime, size)
+        return doc
+
+# default cache, shared by all users
+shared_cache = GFigCache()
+
+# }}}
+
+# Lazy index of file {{{
+
+# any tag (opened or closed), "<style object>" too
+_cre_itag = re.compile(r"<[ \t]*(/?)[ \t]*(\w+)[^\n]*>")
+_cre_iopts = re.compile(r"<[ \t]*/[ \t]*options[ \t]*>[^\n]*\n?", re.I)
+
+def _pointsbbox(text, name=None):
+    """Bounding box (x0, y0, x1, y1) of shape name with points in text
+    (block of lines "x y") or None if text is not such block. Circle,
+    ellipse, poly, star, spiral points are center and radius point(s), arc
+    points are on it's circle, so their box is the box of drawn shape
+    (without out-line), for other shapes it's box of points:
+    >>> _pointsbbox("\\n10 20\\n 5 30\\n")
+    (5, 20, 10, 30)
+    >>> _pointsbbox("\\n10 20 30\\n")
+    >>> _pointsbbox("10 10\\n13 14\\n", "circle")
+    (5, 5, 15, 15)
+    >>> _pointsbbox("10 10\\n13 14\\n", "ellipse")
+    (7, 6, 13, 14)
+    >>> _pointsbbox("0 10\\n10 0\\n20 10\\n", "arc")
+    (0, 0, 20, 20)
+    """
+    try:
+        nums = map(int, text.split())
+    except ValueError:
+        return None
+    if not nums or len(nums) % 2:
+        return None
+    xs = nums[0::2]
+    ys = nums[1::2]
+    if name in (u"circle", u"poly", u"star", u"spiral") and len(nums) >= 4:
+        cx, cy = xs[0], ys[0]
+        r = max(math.hypot(x - cx, y - cy) for x,y in zip(xs[1:], ys[1:]))
+        r = int(math.ceil(r))
+        return (cx - r, cy - r, cx + r, cy + r)
+    elif name == u"ellipse" and len(nums) >= 4:
+        cx, cy = xs[0], ys[0]
+        dx, dy = abs(xs[1] - cx), abs(ys[1] - cy)
+        return (cx - dx, cy - dy, cx + dx, cy + dy)
+    elif name == u"arc" and len(nums) >= 6:
+        # box of circle through 3 points (arc is part of it)
+        (x1, x2, x3), (y1, y2, y3) = xs[:3], ys[:3]
+        d = 2.*(x1*(y2 - y3) + x2*(y3 - y1) + x3*(y1 - y2))
+        if d:
+            s1, s2, s3 = x1*x1 + y1*y1, x2*x2 + y2*y2, x3*x3 + y3*y3
+            cx = (s1*(y2 - y3) + s2*(y3 - y1) + s3*(y1 - y2))/d
+            cy = (s1*(x3 - x2) + s2*(x1 - x3) + s3*(x2 - x1))/d
+            r = math.hypot(x1 - cx, y1 - cy)
+            return (int(math.floor(cx - r)), int(math.floor(cy - r)),
+                    int(math.ceil(cx + r)), int(math.ceil(cy + r)))
+    return (min(xs), min(ys), max(xs), max(ys))
+
+class GFigIndex:
+    """Index of GFig file: header, options (parsed) and for each top-level
+    known shape: name, byte offsets in file, bounding box of drawn shape
+    (or None), number of first line. Points, styles are not built while
+    indexing, shapes are materialized (parsed from their part of file) on
+    demand. src is the file name or file object (should be open while
+    index is used). Encoding should be ASCII-compatible (utf8, cp1251...).
+    Index is used only when caller selects shapes by it (find()) and passes
+    it to GFigRender.render(); GFigRender lookups (ifind_shapes(),
+    name_shapes()) work on rendered shapes and symbols layers render whole
+    files, so they parse all shapes:
+    >>> import StringIO
+    >>> f = StringIO.StringIO("gfig version 0.2\\n<Options>\\n</Options>\\n"
+    ...         "<Line>\\n1 2\\n30 4\\n</Line>\\n<Text>\\n0 0\\n</Text>\\n"
+    ...         "<Circle>\\n10 10\\n15 10\\n<Extra>\\n1\\n</Extra>\\n</Circle>\\n")
+    >>> idx = GFigIndex(f)
+    >>> len(idx), idx.names, idx.bboxes
+    (2, ['line', 'circle'], [(1, 2, 30, 4), (5, 5, 15, 15)])
+    >>> idx.find(name="circle"), idx.find(bbox=(0, 0, 5, 5))
+    ([1], [0, 1])
+    >>> idx.find(bbox=(0, 12, 8, 20)) # only rim of circle, not it's points
+    [1]
+    >>> sh = idx.shape(1)
+    >>> sh.name, sh.points, sh.extra.tolist()
+    (u'circle', [(10.0, 10.0), (15.0, 10.0)], [1])
+    >>> [sh.name for sh in idx.ishapes()]
+    [u'line', u'circle']
+    """
+    def __init__(self, src, encoding="utf8"):
+        self.src = src
+        self.encoding = encoding
+        self.header = [] # list of pairs
+        self.options = [] # list of pairs
+        self.names = [] # names of shapes
+        self.offsets = array("l") # start, end of each shape in file
+        self.nlines = array("l") # zero-based number of first line of each shape
+        self.bboxes = [] # bbox of each shape (see _pointsbbox()) or None
+        if isinstance(src, basestring):
+            st = os.stat(src)
+            self._stat = (st.st_mtime, st.st_size)
+            with open(src, "rb") as f:
+                data = f.read()
+        else:
+            self._stat = None
+            src.seek(0, os.SEEK_SET)
+            data = src.read()
+        self._index(data)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _index(self, data):
+        """Fill index from data (content of file)"""
+        # header and options are small, so parse them as usual
+        m = _cre_iopts.search(data)
+        pos = m.end() if m else len(data)
+        p = _GFigCollector()
+        p.feed(data[:pos].decode(self.encoding))
+        p.close()
+        self.header = p.header
+        self.options = p.options
+
+        nline = data.count("\n", 0, pos)
+        lastpos = pos # nline is number of line of lastpos
+        stack = [] # names of opened tags
+        start = pointspos = None
+        for m in _cre_itag.finditer(data, pos):
+            if pointspos is not None:
+                # points of top-level shape are before any other tag
+                bbox = _pointsbbox(data[pointspos:m.start()], stack[0])
+                pointspos = None
+            close, name = m.groups()
+            name = name.lower()
+            if not close:
+                if not stack:
+                    start, pointspos = data.rfind("\n", 0, m.start()) + 1, m.end()
+                    nline += data.count("\n", lastpos, start)
+                    lastpos = start
+                    bbox = None
+                stack.append(name)
+            else:
+                if not stack or stack[-1] != name:
+                    nline += data.count("\n", lastpos, m.start())
+                    msg = u"unexpected closed tag" if stack else u"unbalanced tag"
+                    raise GFigParseError(msg, nline, m.group().strip())
+                stack.pop()
+                if not stack and name in KNOWN_SHAPES:
+                    end = data.find("\n", m.end()) + 1 or len(data)
+                    self.names.append(intern(name))
+                    self.offsets.extend((start, end))
+                    self.nlines.append(nline)
+                    self.bboxes.append(bbox)
+        if stack or not self.names:
+            nline += data.count("\n", lastpos)
+            msg = u"Unbalanced tags detected" if stack else u"No any shapes"
+            raise GFigParseError(msg, nline)
+
+    def _read(self, start, end):
+        """Returns bytes start..end of file"""
+        if self._stat is None:
+            self.src.seek(start, os.SEEK_SET)
+            return self.src.read(end - start)
+        st = os.stat(self.src)
+        if (st.st_mtime, st.st_size) != self._stat:
+            raise IOError(u"file '%s' was changed after indexing"%self.src)
+        with open(self.src, "rb") as f:
+            f.seek(start, os.SEEK_SET)
+            return f.read(end - start)
+
+    def _imaterialize(self, data, nline):
+        """Iterate over shapes parsed from data (part of file with whole
+        shapes only), nline is the number of it's first line
+        """
+        p = _GFigCollector()
+        p._st = _OBJ
+        p._nline = nline - 1
+        chunks = (data[i:i+p.CHUNKSIZE] for i in xrange(0, len(data), p.CHUNKSIZE))
+        for chunk in codecs.iterdecode(chunks, self.encoding):
+            p.feed(chunk)
+            for sh in p.shapes:
+                yield sh
+            del p.shapes[:]
+        p.close()
+        for sh in p.shapes:
+            yield sh
+
+    def shape(self, i):
+        """Materialize i-th shape"""
+        start, end = self.offsets[2*i], self.offsets[2*i+1]
+        shapes = list(self._imaterialize(self._read(start, end), self.nlines[i]))
+        return shapes[-1] # top-level shape is handled last
+
+    def ishapes(self, indices=None):
+        """Iterate over materialized shapes with indices (all if None),
+        in order of indices. Consecutive shapes are parsed in one pass
+        """
+        if indices is None:
+            indices = xrange(len(self))
+        indices = list(indices)
+        if not indices:
+            return
+        offs = self.offsets
+        lo = min(offs[2*i] for i in indices)
+        hi = max(offs[2*i+1] for i in indices)
+        data = self._read(lo, hi)
+        first = last = indices[0]
+        for i in indices[1:] + [None]:
+            if i is not None and i == last + 1:
+                last = i
+                continue
+            # run first..last is continuous part of file (ignored
+            # shapes between them are ignored by parser too)
+            part = data[offs[2*first]-lo:offs[2*last+1]-lo]
+            for sh in self._imaterialize(part, self.nlines[first]):
+                yield sh
+            first = last = i
+
+    def find(self, name=None, bbox=None):
+        """Returns indices of shapes with name and which bbox (of drawn
+        shape, see _pointsbbox()) intersects bbox (x0, y0, x1, y1). Out-lines
+        are not counted, so extend bbox by their width. Shapes with unknown
+        bbox are always matched by bbox
+        """
+        ret = []
+        for i,n in enumerate(self.names):
+            if name is not None and n != name:
+                continue
+            if bbox is not None:
+                b = self.bboxes[i]
+                if b is not None and (b[0] > bbox[2] or b[2] < bbox[0] or \
+                        b[1] > bbox[3] or b[3] < bbox[1]):
+                    continue
+            ret.append(i)
+        return ret
+
+# }}}
+
+def _bench_parse(filename, repeat=5):
+    """Parse throughput benchmark: usual lexer vs. fast lexer vs. indexing
+    (GFigIndex). Data is read in memory before, so only parsing is measured
+    """
+    import time
+    with open(filename, "rb") as f:
+        data = f.read().decode("utf8")
+    nlines = data.count(u"\n")
+    mb = len(data)/1048576.
+    res = {}
+    for fastlex in (False, True):
+        p = GFigParser(fastlex=fastlex)
+        best = None
+        for i in xrange(repeat):
+            t0 = time.time()
+            p.reset()
+            p.feed(data)
+            p.close()
+            t = time.time() - t0
+            best = t if best is None else min(best, t)
+        res[fastlex] = best
+        print "%-8s %8.3f s  %10d lines/s  %6.2f MB/s"%("fast" if fastlex else "usual",
+                best, nlines/best, mb/best)
+    print "speedup: %.2f"%(res[False]/res[True])
+
+    # indexing only (GFigIndex), file is in memory too
+    import StringIO
+    f = StringIO.StringIO(data.encode("utf8"))
+    best = None
+    for i in xrange(repeat):
+        t0 = time.time()
+        GFigIndex(f)
+        t = time.time() - t0
+        best = t if best is None else min(best, t)
+    print "%-8s %8.3f s  %10d lines/s  %6.2f MB/s"%("index", best, nlines/best, mb/best)
+    print "index vs. fast: %.2f"%(res[True]/best)
+
+def _bench_memory(paths):
+    """Memory benchmark: size of all shapes of gfig files in paths
+    (files or directories, like symbols library) as Shape and in old
+    representation (instance with dict, points as lists of lists)
+    """
+    class OldShape:
+        pass
+    def old_shape(sh):
+        o = OldShape()
+        o.points = [[int(x) for x in p] for p in sh.points]
+        o.extra = list(sh.extra)
+        o.attrs = dict(sh.attrs)
+        o.name = sh.name
+        o._ignored = sh._ignored
+        o.styles = dict(sh.styles)
+        o.opts = {}
+        return o
+    def sizeof(o, seen):
+        """Deep size of o, shared objects are counted once"""
+        if id(o) in seen:
+            return 0
+        seen.add(id(o))
+        n = sys.getsizeof(o)
+        if isinstance(o, dict):
+            n += sum(sizeof(k, seen) + sizeof(v, seen) for k,v in o.iteritems())
+        elif isinstance(o, (list, tuple)):
+            n += sum(sizeof(x, seen) for x in o)
+        elif hasattr(o, "__dict__"):
+            n += sizeof(o.__dict__, seen)
+        for slot in getattr(type(o), "__slots__", ()):
+            if hasattr(o, slot):
+                n += sizeof(getattr(o, slot), seen)
+        return n
+
+    shapes = []
+    nfiles = 0
+    for p in paths:
+        if os.path.isdir(p):
+            files = [os.path.join(d, f) for d,_,fs in os.walk(p) for f in fs]
+        else:
+            files = [p]
+        for fn in files:
+            c = _GFigCollector()
+            try:
+                with open(fn, "rb") as f:
+                    c.parse(f)
+            except Exception:
+                # not gfig file
+                continue
+            shapes.extend(c.shapes)
+            nfiles += 1
+    old = [old_shape(sh) for sh in shapes]
+    new = sizeof(shapes, set())
+    old = sizeof(old, set())
+    print "files: %d, shapes: %d"%(nfiles, len(shapes))
+    print "old    %10d bytes"%old
+    print "Shape  %10d bytes"%new
+    print "ratio: %.2f"%(float(old)/(new or 1))
 
 if __name__ == "__main__":
     import sys
@@ -242,6 +1075,14 @@ if __name__ == "__main__":
     print "Internal tests passed"
 
     if len(sys.argv) < 2:
+        print "args: gfig-file | --bench gfig-file | --membench (gfig-file|dir)..."
+        sys.exit(0)
+
+    if sys.argv[1] == "--bench":
+        _bench_parse(sys.argv[2])
+        sys.exit(0)
+    elif sys.argv[1] == "--membench":
+        _bench_memory(sys.argv[2:])
         sys.exit(0)
 
 
@@ -260,8 +1101,8 @@ if __name__ == "__main__":
     p = MyGFigParser()
     f = None
     try:
-        f = open(sys.argv[1], "rt")
-        p.feed(f.read().decode("utf8"))
+        f = open(sys.argv[1], "rb")
+        p.parse(f)
     except Exception, x:
         print unicode(x)
     finally:
@@ -0,0 +1,85 @@
+# Background loading of symbols
+import sys
+from multiprocessing.pool import ThreadPool
+from pybase import gfig
+from pybase.hmi.sym import SymModule, BaseSymbol
+
+def _load_assets(name):
+    """Reads files of symbol with name, decodes not empty frames of it's image
+    and parses gfig files of vector layers (they are kept in gfig.shared_cache).
+    Runs in worker thread, so touches nothing of Tk. Returns (name, prototype,
+    frames, error)
+    """
+    try:
+        proto = SymModule.prototype(name)
+        if not proto:
+            raise ValueError(u"Symbol '%s' not found"%name)
+        frames = [proto.frame(i) for i in xrange(proto.nframes)]
+        for p in proto.fs["vlayers"]:
+            gfig.shared_cache.load(p, BaseSymbol._GFIG_ENCODING)
+        return (name, proto, frames, None)
+    except Exception, x:
+        return (name, None, None, x)
+
+class SymLoader:
+    """Loads symbols assets in pool of threads: files, decoded frames,
+    parsed gfig files (PIL decoding and gfig parsing don't need Tk). Loaded
+    payloads are handed to Tk thread through TkAsync.post(), where decoded
+    frames are given to prototype of symbol, so next BaseSymbol() and render()
+    of loaded symbol don't read and decode files at all (only PhotoImages of
+    shown frames are created).
+    SymModule should be mounted!
+    """
+    def __init__(self, tkasync, processes=2):
+        """tkasync is TkAsync of application (tkroot.tkasync), processes is
+        number of worker threads
+        """
+        self.tkasync = tkasync
+        self.processes = processes
+        self._pool = None # is created on first load()
+        self._pending = {} # {name: [callback]}, is used only in Tk thread
+
+    def load(self, names, callback=None):
+        """Starts loading of symbols with names. callback(name, error) is called
+        in Tk thread for each of them when it's loaded, error is None or
+        Exception. Symbol which is loading already is not loaded twice
+        """
+        if self._pool is None:
+            self._pool = ThreadPool(self.processes)
+        for name in names:
+            callbacks = self._pending.get(name)
+            if callbacks is None:
+                callbacks = self._pending[name] = []
+                # result callback runs in result-handler thread of pool
+                self._pool.apply_async(_load_assets, (name,),
+                        callback=lambda res: self.tkasync.post(self._loaded, *res))
+            if callback:
+                callbacks.append(callback)
+
+    def _loaded(self, name, proto, frames, error):
+        """Payload of symbol is came (in Tk thread). Decoded frames are kept
+        by prototype, PhotoImages are created on rendering (see
+        _Prototype.photo()). Exceptions here would stop TkAsync, so exceptions
+        of callbacks are reported like errors of Tk callbacks
+        """
+        if self._pool is None:
+            # closed while loading
+            return
+        if error is None:
+            proto.setframes(frames)
+        for callback in self._pending.pop(name, ()):
+            try:
+                callback(name, error)
+            except Exception:
+                self.tkasync.master.report_callback_exception(*sys.exc_info())
+
+    def pending(self):
+        """Returns number of symbols which are loading now"""
+        return len(self._pending)
+
+    def close(self):
+        """Stops workers, not loaded symbols are not delivered"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        self._pending = {}
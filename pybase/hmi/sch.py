@@ -13,7 +13,9 @@ from Tkconstants import *
 from datetime import datetime
 from pybase.tk import utils as tkutils
 from pybase import utils
+from pybase import geom
 from pybase.hmi.sym import SymModule
+from pybase.hmi.loader import SymLoader
 from pybase.hmi import sim
 from pybase.vroot import *
 from pybase.dotcfg import DotCfg, Parameter
@@ -254,6 +256,14 @@ class BaseScheme(SchModule):
         self.tag = None # tag of background image
         self._key = key
         self._symbols = collections.defaultdict(list) # key is BaseSymbol.k[key]
+        self._grid = None # spatial index of symbols (GridIndex), is created on search
+        self._dirty = set() # symbols with changed bbox (not updated in _grid)
+        self._order = {} # {symbol:order of rendering}
+        self._norder = itertools.count()
+        self._resizeafter = None # id of after() for relayout()
+        self._resizeevent = None # last event of resize()
+        self._loader = None # SymLoader, is created on first render_symbol_async()
+        self._placeholders = {} # {canvas id: (name, x, y, layers, kw, order)}
         self._imfname = self.fs["gif"] or self.fs["png"]
         if not self._imfname:
             raise ValueError(u"No scheme image found")
@@ -385,30 +395,80 @@ class BaseScheme(SchModule):
             except:
                 pass
         self._symbols = collections.defaultdict(list)
+        self._grid = None
+        self._dirty = set()
+        self._order = {}
+        for ph in self._placeholders:
+            self.c.delete(ph)
+        self._placeholders = {}
+        if self._loader is not None:
+            # stop worker threads of loader
+            self._loader.close()
+            self._loader = None
+        if self._resizeafter is not None:
+            self.c.after_cancel(self._resizeafter)
+            self._resizeafter = None
         self.__delete_background()
 
+    GRIDCELL = 64 # size of cell of spatial index
+
+    def _bboxchanged(self, sym):
+        """bbox of BaseSymbol sym was changed"""
+        if self._grid is not None:
+            self._dirty.add(sym)
+
+    def _getgrid(self):
+        """Returns actual spatial index of symbols (BaseSymbol's)
+        """
+        if self._grid is None:
+            self._grid = geom.GridIndex(self.GRIDCELL)
+            self._dirty = set(sym.sym for sym in self.itersymbols())
+        while self._dirty:
+            # bbox() can change bboxes (commit pending transformations)
+            dirty, self._dirty = self._dirty, set()
+            for sym in dirty:
+                if sym in self._order:
+                    self._grid.insert(sym, sym.bbox(), self._order[sym])
+        return self._grid
+
     def ifind_at(self, x, y):
-        """Find all symbols at canvas coords x,y. Yields BaseSymbol's, not
-        _Symbols
+        """Find all symbols at canvas coords x,y in order of their rendering.
+        Yields BaseSymbol's, not _Symbols
         """
-        for sym in self.itersymbols():
-            bx0,by0,bx1,by1 = sym.sym.bbox()
-            if bx0 <= x <= bx1 and by0 <= y <= by1:
-                yield sym.sym
+        for sym in self._getgrid().find(x, y):
+            yield sym
 
     def find_at(self, x, y):
         """Similar to ifind_at but returns list
         """
         return list(self.ifind_at(x, y))
 
+    RESIZEDELAY = 50 # ms without resize() before relayout()
+
     def resize(self, event=None):
-        """On canvas resizing must be called"""
+        """On canvas resizing must be called. Bursts of calls are debounced:
+        scheme is relayouted once, RESIZEDELAY ms after the last call
+        """
+        self._resizeevent = event
+        if self._resizeafter is not None:
+            self.c.after_cancel(self._resizeafter)
+        self._resizeafter = self.c.after(self.RESIZEDELAY, self.relayout)
+
+    def relayout(self):
+        """Resize background and place shapes of symbols for actual
+        canvas size now
+        """
+        if self._resizeafter is not None:
+            self.c.after_cancel(self._resizeafter)
+            self._resizeafter = None
         #self.render()
-        self.__resize_background(event)
+        self.__resize_background(self._resizeevent)
         #self.__delete_background()
         #self.__create_background(self._imfname)
+        canw = float(self.c.winfo_width())
+        canh = float(self.c.winfo_height())
         for sym in self.itersymbols():
-            sym.sym.resize(event)
+            sym.sym.relayout(canw, canh)
 
     def schcoords(self, canx, cany):
         """Convert from canvas coordinates to scheme coordinates,
@@ -443,10 +503,65 @@ class BaseScheme(SchModule):
             sym = _Symbol(self, name, x, y, *layers, **kw)
             key = sym.sym.k.get(self._key, "noname")
             self._symbols[key].append(sym)
+            self._order[sym.sym] = next(self._norder)
+            sym.sym.bboxchanged = self._bboxchanged
+            self._bboxchanged(sym.sym)
             return sym.sym
         else:
             return None
 
+    LOADERTHREADS = 2 # worker threads of SymLoader
+    PLACEHOLDERSIZE = 16 # size of placeholder of not loaded symbol
+    PLACEHOLDEROPTS = {"outline": "gray50", "dash": (2, 2)}
+    PLACEHOLDERERROROPTS = {"outline": "red", "dash": ()}
+
+    def prefetch(self, names):
+        """Starts loading of symbols with names in background (see
+        pybase.hmi.loader), so next render_symbol() does not read files
+        """
+        if self._loader is None:
+            self._loader = SymLoader(self.app.tkroot.tkasync, self.LOADERTHREADS)
+        self._loader.load(names)
+
+    def render_symbol_async(self, name, x, y, *layers, **kw):
+        """Like render_symbol() but does not block: shows placeholder and
+        loads symbol files in background, then symbol is rendered instead
+        of placeholder (in Tk thread, see TkAsync). Order of symbols for
+        find_at() is the order of calls, not of loading. If symbol can not be
+        loaded, placeholder stays with PLACEHOLDERERROROPTS. Returns canvas
+        id of placeholder
+        """
+        if self._loader is None:
+            self._loader = SymLoader(self.app.tkroot.tkasync, self.LOADERTHREADS)
+        canx, cany = self.cancoords(x, y)
+        d = self.PLACEHOLDERSIZE/2
+        ph = self.c.create_rectangle(canx - d, cany - d, canx + d, cany + d,
+                **self.PLACEHOLDEROPTS)
+        self._placeholders[ph] = (name, x, y, layers, kw, next(self._norder))
+        self._loader.load([name], lambda name, error: self.__loaded(ph, error))
+        return ph
+
+    def __loaded(self, ph, error):
+        """Symbol of placeholder ph is loaded (in Tk thread)"""
+        if ph not in self._placeholders:
+            # scheme was deleted (or rendered again) while loading
+            return
+        if error is None:
+            name, x, y, layers, kw, order = self._placeholders[ph]
+            try:
+                sym = self.render_symbol(name, x, y, *layers, **kw)
+            except Exception, e:
+                error = e
+            else:
+                if sym is not None:
+                    self._order[sym] = order
+        if error is None:
+            del self._placeholders[ph]
+            self.c.delete(ph)
+        else:
+            # exception here would break TkAsync
+            self.c.itemconfigure(ph, **self.PLACEHOLDERERROROPTS)
+
     def render(self):
         """Render. To render some symbols, overload this method and use in it
         render_symbol(), but first call base class render()!
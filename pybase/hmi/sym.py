@@ -1,5 +1,10 @@
+import multiprocessing
 import collections
+import py_compile
 import itertools
+import tempfile
+import hashlib
+import cPickle
 import random
 import codecs
 import shutil
@@ -10,11 +15,14 @@ import sys
 import os
 import re
 from pybase import utils
+from pybase import gfig
 from pybase.hmi import sim
 from pybase.vroot import *
 from pybase.tk.gfig import *
+from pybase.tk import raster
 from pybase.dotcfg import DotCfg, DOT
-from PIL import Image, ImageTk, ImageStat
+from Tkconstants import *
+from PIL import Image, ImageTk
 from os import path
 
 cre_vlayername = re.compile("[^\d]*(\d+)[^\d]*")
@@ -58,18 +66,30 @@ class Symbol(BaseSymbol):
 """
 
     DIR = "usr/share/sym" # after init will be absolute path
+    CACHEDIR = "var/cache/gfig" # dir. of parsed gfig files cache (in root)
+    PRECOMPDIR = "var/cache/sym" # dir. of precompiled symbols (in root)
+    PRECOMPEXT = ".symc"
+    PRECOMPVERSION = 1 # version of format of precompiled symbol
+    THUMBDIR = "var/cache/thumbs" # dir. of symbols thumbnails (in root)
+    FRAMESDIR = "var/cache/frames" # dir. of metadata of images frames (in root)
     _ready = False # register already as finder, loader
 
     @classmethod
-    def mount(class_, root):
+    def mount(class_, root, diskcache=False):
         """init finder,loader, only once;
-        root is catalogue of portable root"""
+        root is catalogue of portable root. If diskcache, parsed
+        gfig files will be cached in CACHEDIR too (not only in memory)"""
         # XXX class_ - in successors own _ready (?)
         if class_._ready:
             return
         else:
-            p = VRoot(root).hpath(SymModule.DIR)
-            SymModule.DIR = VRoot(p)
+            vr = VRoot(root)
+            SymModule.DIR = VRoot(vr.hpath(SymModule.DIR))
+            SymModule.PRECOMPDIR = vr.hpath(SymModule.PRECOMPDIR)
+            SymModule.THUMBDIR = vr.hpath(SymModule.THUMBDIR)
+            SymModule.FRAMESDIR = vr.hpath(SymModule.FRAMESDIR)
+            if diskcache:
+                gfig.shared_cache.cachedir = vr.hpath(SymModule.CACHEDIR)
             class_._ready = True
 
     @staticmethod
@@ -169,7 +189,12 @@ class Symbol(BaseSymbol):
         symdir = SymModule.DIR.hpath(name)
         if not path.exists(symdir):
             return None
+        return SymModule._dirfiles(symdir)
 
+    @staticmethod
+    def _dirfiles(symdir):
+        """Like files() but for symbol directory symdir (absolute path)
+        """
         ret = {k:None for k in ("vlayers", "gif", "tiff", "descr", "py", "dsl", "dir")}
         ret["dir"] = symdir
         ret["vlayers"] = []
@@ -196,6 +221,204 @@ class Symbol(BaseSymbol):
         ret["vlayers"] = collections.OrderedDict(svl).values()
         return ret
 
+    @staticmethod
+    def names():
+        """Returns sorted list of names of all symbols in catalog
+        """
+        if not SymModule._ready:
+            raise ValueError("not mounted")
+
+        symroot = SymModule.DIR.hpath(u"")
+        ret = []
+        for d, dirs, fnames in os.walk(symroot):
+            if SymModule.DESCR in fnames and SymModule.PYMODULE in fnames:
+                ret.append(path.relpath(d, symroot).replace(path.sep, u"/"))
+        return sorted(ret)
+
+    # Precompiled symbols {{{
+
+    # Precompiled symbol is the pickled dict with parsed descr keywords,
+    # gfig layers, decoded image frames (empty are already dropped). sym.py
+    # is byte-compiled near itself. It's valid while stamps (mtime, size)
+    # of all symbol files are the same
+
+    @staticmethod
+    def _precompiled_path(name):
+        """Path of precompiled symbol file"""
+        fname = hashlib.md5(name.encode("utf8")).hexdigest() + SymModule.PRECOMPEXT
+        return path.join(SymModule.PRECOMPDIR, fname)
+
+    @staticmethod
+    def _stamps(fs):
+        """Returns {path:(mtime, size)} for all used files of symbol,
+        fs is the files()
+        """
+        ret = {}
+        for k in ("descr", "py", "gif", "tiff"):
+            if fs[k]:
+                st = os.stat(fs[k])
+                ret[fs[k]] = (st.st_mtime, st.st_size)
+        for p in fs["vlayers"]:
+            st = os.stat(p)
+            ret[p] = (st.st_mtime, st.st_size)
+        return ret
+
+    @staticmethod
+    def load_precompiled(name, fs=None):
+        """Returns precompiled symbol (dict) or None if it does not
+        exist or is stale. fs is files() of symbol (if already got)
+        """
+        if not SymModule._ready:
+            raise ValueError("not mounted")
+
+        if fs is None:
+            fs = SymModule.files(name)
+            if not fs:
+                return None
+        try:
+            with open(SymModule._precompiled_path(name), "rb") as f:
+                art = cPickle.load(f)
+            if art["version"] == SymModule.PRECOMPVERSION and art["name"] == name and \
+                    art["stamps"] == SymModule._stamps(fs):
+                return art
+        except Exception:
+            pass
+        return None
+
+    @staticmethod
+    def precompile(names=None, processes=None):
+        """Precompile symbols with names (all of catalog if None) by pool
+        of processes (number of CPUs if None). Returns {name:error}, where
+        error is None on success or message
+        """
+        if not SymModule._ready:
+            raise ValueError("not mounted")
+
+        if names is None:
+            names = SymModule.names()
+        if not path.exists(SymModule.PRECOMPDIR):
+            os.makedirs(SymModule.PRECOMPDIR)
+        tasks = [(n, SymModule.DIR.hpath(n), SymModule._precompiled_path(n)) for n in names]
+        if processes == 1:
+            return dict(itertools.imap(_precompile_symbol, tasks))
+        pool = multiprocessing.Pool(processes)
+        try:
+            return dict(pool.imap_unordered(_precompile_symbol, tasks))
+        finally:
+            pool.close()
+            pool.join()
+
+    # }}}
+
+    # Prototypes {{{
+
+    # Prototype is the data shared by all symbols with the same name: files(),
+    # keywords, decoded image frames and their PhotoImages. So scheme with many
+    # copies of symbol reads and decodes its files once. It's valid while
+    # mtime of symbol directory and stamps of descr, image file are the same
+
+    _prototypes = {} # {name: _Prototype}
+    # LRU of decoded frames and their PhotoImages (see _Prototype.photo())
+    photos = raster.ImageCache(256)
+
+    @staticmethod
+    def _protostamp(fs):
+        """Returns stamp of prototype for files() fs"""
+        ret = [os.stat(fs["dir"]).st_mtime]
+        for p in (fs["descr"], fs["gif"] or fs["tiff"]):
+            if p:
+                st = os.stat(p)
+                ret.append((st.st_mtime, st.st_size))
+        return tuple(ret)
+
+    @staticmethod
+    def prototype(name):
+        """Returns prototype (cached) of symbol with name or None if symbol
+        directory does not exist
+        """
+        if not SymModule._ready:
+            raise ValueError("not mounted")
+
+        proto = SymModule._prototypes.get(name)
+        if proto is not None:
+            try:
+                if SymModule._protostamp(proto.fs) == proto.stamp:
+                    return proto
+            except OSError:
+                pass
+            # can be called from loader threads (see pybase.hmi.loader)
+            SymModule._prototypes.pop(name, None)
+        fs = SymModule.files(name)
+        if not fs:
+            return None
+        # stamp before reading, so changes while reading make it stale
+        stamp = SymModule._protostamp(fs)
+        art = SymModule.load_precompiled(name, fs)
+        if art:
+            # already parsed gfig files
+            for p, mtime, size, doc in art["vlayers"]:
+                gfig.shared_cache.put(p, doc, mtime, size)
+            frames = [f for f in art["frames"] if not getattr(f, "_noimage", False)]
+            proto = _Prototype(name, stamp, fs, art["k"], art["frames"][-1].size, frames=frames)
+        else:
+            try:
+                k = _load_keywords(fs["descr"])
+            except:
+                k = {}
+            imfilename = fs["gif"] or fs["tiff"]
+            if not imfilename:
+                raise ValueError(u"No symbol image found")
+            # frames are decoded on rendering
+            size, framenums, palette = _image_frames_index(imfilename, SymModule.FRAMESDIR)
+            proto = _Prototype(name, stamp, fs, k, size, framenums=framenums,
+                    palette=palette)
+        SymModule._prototypes[name] = proto
+        return proto
+
+    @staticmethod
+    def clear_prototypes():
+        SymModule._prototypes.clear()
+        SymModule.photos.clear()
+
+    # }}}
+
+    # Images without Tk {{{
+
+    @staticmethod
+    def image(name):
+        """Returns RGBA Image of symbol like it's shown with all layers:
+        not empty frames of raster image, then vector layers (without labels).
+        Tk is not used, so is good for batch jobs
+        """
+        proto = SymModule.prototype(name)
+        if not proto:
+            raise ValueError(NOSYMBOLERR%name)
+        size = proto.size
+        im = Image.new("RGBA", size, (0, 0, 0, 0))
+        for i in xrange(proto.nframes):
+            im = Image.alpha_composite(im, proto.frame(i).convert("RGBA"))
+        # gfig coords are relative to left-top corner of frames (see Vlayer.render())
+        for p in proto.fs["vlayers"]:
+            layer = gfig_image(p, BaseSymbol._GFIG_ENCODING, bbox=(0, 0) + size,
+                    cache=gfig.shared_cache)
+            im = Image.alpha_composite(im, layer)
+        return im
+
+    @staticmethod
+    def thumbnail(name, size=(64, 64)):
+        """Returns thumbnail (not bigger than size) of image() of symbol. It's
+        cached in THUMBDIR by contents of symbol image and gfig files
+        """
+        proto = SymModule.prototype(name)
+        if not proto:
+            raise ValueError(NOSYMBOLERR%name)
+        fs = proto.fs
+        sources = [fs[k] for k in ("gif", "tiff") if fs[k]] + fs["vlayers"]
+        cache = raster.ThumbnailCache(SymModule.THUMBDIR)
+        return cache.thumbnail(sources, lambda: SymModule.image(name), size)
+
+    # }}}
+
 # }}}
 
 
@@ -228,10 +451,14 @@ class Symbol(BaseSymbol):
 # }}}
 
 def _is_empty_image(image):
-    """Test that image is empty
+    """Test that image is empty: all pixels are the same (min and max of
+    each band are equal), like zero variance but without statistics
     """
-    stat = ImageStat.Stat(image)
-    return all(s==0.0 for s in stat.var)
+    ext = image.getextrema()
+    if not isinstance(ext[0], tuple):
+        # one band
+        ext = (ext,)
+    return all(lo == hi for lo, hi in ext)
 
 def _load_image_frames(filename):
     """Iterator over frames of image, each item is Image. Keep
@@ -258,12 +485,180 @@ def _load_image_frames(filename):
         pass
     if noimage:
         # if no any not empty frames, then yield dummy frame
-        class EmptyFrame: pass
-        f = EmptyFrame()
+        f = _EmptyFrame()
         f._noimage = True
         f.size = size
         yield f
 
+class _EmptyFrame:
+    """Dummy frame of empty image"""
+    pass
+
+FRAMESMETAVERSION = 1 # version of format of frames metadata file
+FRAMESMETAEXT = ".frm"
+
+def _frames_meta_path(filename, cachedir):
+    """Path of frames metadata file of image filename"""
+    if isinstance(filename, unicode):
+        filename = filename.encode("utf8")
+    return path.join(cachedir, hashlib.md5(filename).hexdigest() + FRAMESMETAEXT)
+
+def _image_frames_index(filename, cachedir=None):
+    """Returns size of image, numbers of it's not empty frames and palette
+    of image (list or None) like _load_image_frames() but without conversion
+    of frames. If cachedir, result is kept there while mtime, size of image
+    file are the same, so empty frames are not decoded next time
+    """
+    if cachedir:
+        st = os.stat(filename)
+        stamp = (st.st_mtime, st.st_size)
+        metapath = _frames_meta_path(filename, cachedir)
+        try:
+            with open(metapath, "rb") as f:
+                meta = cPickle.load(f)
+            if meta["version"] == FRAMESMETAVERSION and meta["filename"] == filename and \
+                    meta["stamp"] == stamp:
+                return meta["size"], meta["framenums"], meta["palette"]
+        except Exception:
+            pass
+    im = Image.open(filename)
+    size = im.size
+    palette = im.getpalette() if im.mode == "P" else None
+    ret = []
+    try:
+        i = 0
+        while True:
+            if not _is_empty_image(im):
+                ret.append(i)
+            i += 1
+            im.seek(i)
+    except (ValueError, EOFError, IndexError):
+        pass
+    if cachedir:
+        meta = {"version":FRAMESMETAVERSION, "filename":filename, "stamp":stamp,
+                "size":size, "framenums":ret, "palette":palette}
+        try:
+            if not path.exists(cachedir):
+                os.makedirs(cachedir)
+            # via temp. file, so other processes never see not finished file
+            fd, tmp = tempfile.mkstemp(dir=cachedir)
+            with os.fdopen(fd, "wb") as f:
+                cPickle.dump(meta, f, cPickle.HIGHEST_PROTOCOL)
+            if path.exists(metapath):
+                os.remove(metapath) # rename() on Windows can not replace
+            os.rename(tmp, metapath)
+        except (IOError, OSError):
+            # cache is optional (read-only root...)
+            pass
+    return size, ret, palette
+
+def _load_image_frame(filename, framenum, palette=None):
+    """Load frame framenum of image like _load_image_frames() does.
+    palette is the palette of image (see _image_frames_index()) if known
+    """
+    im = Image.open(filename)
+    plt = palette or copy.copy(im.palette)
+    im.seek(framenum)
+    imc = im.convert("P")
+    imc.putpalette(plt)
+    return imc
+
+class _Prototype:
+    """Data shared by symbols with the same name (see SymModule.prototype()).
+    Not empty frames of image (raster layers) are decoded on demand (or are
+    kept if precompiled or loaded in background), their PhotoImages are
+    created on rendering
+    """
+    def __init__(self, name, stamp, fs, k, size, framenums=(), frames=None,
+            palette=None):
+        """framenums are numbers of not empty frames in image file,
+        frames are already decoded not empty frames (if precompiled),
+        palette is the palette of image file (if known)
+        """
+        self.name = name
+        self.stamp = stamp
+        self.fs = fs # files()
+        self.k = k # keywords
+        self.size = size # size of all frames
+        self._framenums = framenums
+        self._frames = frames
+        self._palette = palette
+        self.nframes = len(frames) if frames is not None else len(framenums)
+
+    def frame(self, num):
+        """Returns decoded not empty frame (Image) number num"""
+        if self._frames is not None:
+            return self._frames[num]
+        return _load_image_frame(self.fs["gif"] or self.fs["tiff"], self._framenums[num],
+                self._palette)
+
+    def setframes(self, frames):
+        """Keep already decoded not empty frames (see pybase.hmi.loader),
+        so frame() and photo() don't decode them
+        """
+        self._frames = frames
+
+    def photo(self, num):
+        """Returns (frame, PhotoImage) of not empty frame number num. They are
+        kept in LRU SymModule.photos, so not visible frames are released
+        """
+        key = (self.name, self.stamp, num)
+        ret = SymModule.photos.get(key)
+        if ret is None:
+            im = self.frame(num)
+            ret = (im, ImageTk.PhotoImage(im))
+            SymModule.photos.put(key, ret)
+        return ret
+
+def _load_keywords(filename):
+    """Load keywords from descr file. Keywords are options
+    like 'k.something = some_value', returns dict
+    """
+    ret = {}
+    dc = DotCfg()
+    with codecs.open(filename, "r", encoding="utf8") as f:
+        dc.parse(f)
+        for p in dc.paths:
+            if len(p) == 2 and p[0] == u"k":
+                ret[p[1]] = dc.get(DOT.join(p)).value
+    return ret
+
+def _precompile_symbol(task):
+    """Precompile one symbol (in pool worker), task is (name, symdir,
+    artifact path). Returns (name, None) or (name, error message)
+    """
+    name, symdir, artpath = task
+    try:
+        fs = SymModule._dirfiles(symdir)
+        # stamps before reading, so changes while compiling make it stale
+        stamps = SymModule._stamps(fs)
+        try:
+            k = _load_keywords(fs["descr"])
+        except:
+            k = {}
+        cache = gfig.GFigCache()
+        vlayers = []
+        for p in fs["vlayers"]:
+            mtime, size = stamps[p]
+            vlayers.append((p, mtime, size, cache.load(p, BaseSymbol._GFIG_ENCODING)))
+        imfilename = fs["gif"] or fs["tiff"]
+        if not imfilename:
+            raise ValueError(u"No symbol image found")
+        frames = list(_load_image_frames(imfilename))
+        py_compile.compile(fs["py"], doraise=True)
+        art = {"version":SymModule.PRECOMPVERSION, "name":name, "stamps":stamps,
+                "k":k, "vlayers":vlayers, "frames":frames}
+        # via temp. file, so other processes never see not finished file
+        fd, tmp = tempfile.mkstemp(dir=path.dirname(artpath))
+        with os.fdopen(fd, "wb") as f:
+            cPickle.dump(art, f, cPickle.HIGHEST_PROTOCOL)
+        if path.exists(artpath):
+            os.remove(artpath) # rename() on Windows can not replace
+        os.rename(tmp, artpath)
+        return (name, None)
+    except Exception, x:
+        return (name, unicode(x) or repr(x))
+
 # Layers classes {{{
 
 class Layer:
@@ -274,6 +669,7 @@ class Layer:
         self.sym = sym
         self.num = num
         self.visible = False
+        self.hidden = False # canvas items exist but are hidden (see hide())
 
 #    def __del__(self):
 #        try:
@@ -285,11 +681,20 @@ class Layer:
         """Delete layer from canvas (unrender). Override but call base at last!
         """
         self.visible = False
+        self.hidden = False
+
+    def hide(self):
+        """Hide layer but keep it's canvas items, so next render() only shows
+        them (see BaseSymbol._RESIDENT). Override but call base at last!
+        """
+        self.visible = False
+        self.hidden = True
 
     def render(self):
-        """Render itself. Override but call base at last!
+        """Render itself (show if is hidden). Override but call base at last!
         """
         self.visible = True
+        self.hidden = False
 
     def tags(self):
         """Returns list of canvas tags of all layer objects
@@ -302,35 +707,61 @@ class Layer:
 #        raise NotImplementedError
 
 class Rlayer(Layer):
-    """Raster layer
+    """Raster layer: not empty frame num of symbol image. Frame is decoded
+    and it's PhotoImage is created on first render()
     """
-    def __init__(self, sym, num, image, photoimage):
-        """image is Image object, photoimage is the ImageTk.PhotoImage
+    def __init__(self, sym, num, proto):
+        """proto is the _Prototype of symbol
         """
         Layer.__init__(self, sym, num)
-        self.im = image
-        self.ph = photoimage
+        self.proto = proto
+        self.im = None # Image and PhotoImage of frame, while is visible
+        self.ph = None
         self.tag = None
 
     def delete(self, really=True):
-        """If really is not True, image resources will
-        not be deleted"""
-        if self.visible:
+        """Image resources are released in any case (really is ignored):
+        they are kept in LRU SymModule.photos for next render()"""
+        if self.visible or self.hidden:
             self.sym.c.delete(self.tag)
             self.tag = None
-            if really:
-                self.ph = None
-                self.im = None
+            self.ph = None
+            self.im = None
             Layer.delete(self)
+            self.sym._bboxchanged()
+
+    def hide(self):
+        if self.visible:
+            self.sym.c.itemconfigure(self.tag, state=HIDDEN)
+            Layer.hide(self)
+            self.sym._bboxchanged()
 
     def render(self):
+        if self.hidden:
+            self.sym.c.itemconfigure(self.tag, state=NORMAL)
+            Layer.render(self)
+            self.sym._bboxchanged()
+            return
         self.delete()
+        self.im, self.ph = self.proto.photo(self.num)
         self.tag = self.sym.c.create_image(self.sym.x, self.sym.y, image=self.ph)
         Layer.render(self)
+        self.sym._bboxchanged()
 
     def tags(self):
         return [self.tag,]
 
+    def bbox(self):
+        """Bound box of canvas item (like Tk calculates it for image
+        with center anchor) or None if it's not visible
+        """
+        if not self.visible:
+            return None
+        w, h = self.proto.size
+        x = int(self.sym.x + (0.5 if self.sym.x >= 0 else -0.5)) - w//2
+        y = int(self.sym.y + (0.5 if self.sym.y >= 0 else -0.5)) - h//2
+        return (x, y, x + w, y + h)
+
     def __str__(self):
         """Returns rNUM"""
         return "r%d"%self.num
@@ -346,13 +777,24 @@ class Vlayer(Layer):
         self.filename = filename
 
     def delete(self, really=True):
-        if self.visible:
+        if self.visible or self.hidden:
             self.gfr.delete()
             if really:
                 self.gfr = None
             Layer.delete(self)
 
+    def hide(self):
+        if self.visible:
+            self.gfr.sethidden(True)
+            Layer.hide(self)
+            self.sym._bboxchanged()
+
     def render(self):
+        if self.hidden:
+            self.gfr.sethidden(False)
+            Layer.render(self)
+            self.sym._bboxchanged()
+            return
         self.delete()
         self.gfr.render(self.filename)
         # All gfig coords are on Gfig (Gimp) canvas, without any offsets.
@@ -380,53 +822,58 @@ class BaseSymbol(SymModule):
     If you need any tk-async method use @tksafe from pybase.hmi.utils
     """
     _GFIG_ENCODING = "utf8"
+    # updates of vlayers shapes (ondata()) are sent to Tk once per frame
+    # (see CanvasQueue in pybase.tk.gfig); errors of updates (bad color, for
+    # ex.) are reported later, not raised to the script
+    _GFIG_QUEUED = False
+    # vlayers are shown as images until script touches their shapes (see
+    # RasterCanvas in pybase.tk.raster), good for static symbols of big
+    # overview schemes
+    _GFIG_FLAT = False
+    # polylines, polygons of vlayers are simplified to pixel tolerance and
+    # tiny shapes are hidden (see GFigRender), good for shrunken symbols
+    _GFIG_LOD = False
+    # layers are created once, then not selected layers are hidden instead
+    # of deletion (see render()), good for blinking symbols
+    _RESIDENT = False
     format = u"symbol,1"
 
     def __init__(self, name, canvas, x, y):
-        self.fs = self.files(name)
-        if not self.fs:
+        # files, keywords, image frames are shared with other symbols
+        # with this name (see prototype())
+        proto = self.prototype(name)
+        if not proto:
             raise Exception(u"Inconsistent symbol (or mismatched location)")
+        self.fs = proto.fs
         self.name = name
         self.c = canvas
         self._vlayers = []
         self._rlayers = []
         self._vilayers = [] # all visible only layers
+        self._stack = [] # visible and hidden layers in stacking order
         self.x = x
         self.y = y
         self.width = self.height = 0
         self._pmenu = None # popup menu
-        self.k = {} # keywords, for ex. "sid" (Signal IDeintifier)
-
-        # Try to load keywords from descr. Keywords are options in
-        # 'descr' file like:
+        # keywords, for ex. "sid" (Signal IDeintifier). Keywords are options
+        # in 'descr' file like:
         #   k.something = some_value
-        try:
-            dc = DotCfg()
-            with codecs.open(self.fs["descr"], "r", encoding="utf8") as f:
-                dc.parse(f)
-                for p in dc.paths:
-                    if len(p) == 2 and p[0] == u"k":
-                        self.k[p[1]] = dc.get(DOT.join(p)).value
-        except:
-            pass
+        self.k = dict(proto.k)
+        # when is set (by owner), is called with self when bbox is changed
+        self.bboxchanged = None
 
         # create Vlayers
         for i,p in enumerate(self.fs["vlayers"]):
-            g = GFigRender(self.c, BaseSymbol._GFIG_ENCODING)
+            g = GFigRender(self.c, BaseSymbol._GFIG_ENCODING, cache=gfig.shared_cache,
+                    queued=self._GFIG_QUEUED, flat=self._GFIG_FLAT, lod=self._GFIG_LOD)
+            g.bboxchanged = self._bboxchanged
             self._vlayers.append(Vlayer(self, i, g, p))
 
-        # create Rlayer
-        imfilename = self.fs["gif"] or self.fs["tiff"]
-        if not imfilename:
-            raise ValueError(u"No symbol image found")
-        for i,f in enumerate(_load_image_frames(imfilename)):
-            if not getattr(f, "_noimage", False):
-                ph = ImageTk.PhotoImage(f)
-                self._rlayers.append(Rlayer(self, i, f, ph))
+        # create Rlayers (frames are decoded on rendering)
+        for i in xrange(proto.nframes):
+            self._rlayers.append(Rlayer(self, i, proto))
 
-        # size of symbol will be size of last frame (all are equals)
-        self.width = f.size[0]
-        self.height = f.size[1]
+        self.width, self.height = proto.size
 
 #    def __del__(self):
 #        try:
@@ -445,6 +892,7 @@ class BaseSymbol(SymModule):
         self._vlayers = []
         self._rlayers = []
         self._vilayers = []
+        self._stack = []
         # destroy popup menu
         self.delete_popup_menu()
 
@@ -516,7 +964,7 @@ class BaseSymbol(SymModule):
         """
         for l in self._vilayers:
             if isinstance(l, Rlayer):
-                bb = self.c.bbox(l.tag)
+                bb = l.bbox()
                 if bb:
                     bx0,by0,bx1,by1 = bb
                     if bx0 <= x <= bx1 and by0 <= y <= by1:
@@ -554,14 +1002,15 @@ class BaseSymbol(SymModule):
 
     def delete_visible(self):
         """Delete from canvas all created items - clear canvas (clear all
-        visible layers)
+        visible layers), hidden layers too
         """
-        for l in self._vilayers:
+        for l in self._stack:
             try:
                 l.delete(really=False)
             except:
                 pass
         self._vilayers = []
+        self._stack = []
 
     @property
     def rendered(self):
@@ -578,56 +1027,98 @@ class BaseSymbol(SymModule):
         return False
 
     def render(self, layers=None):
-        """Render selected layers (use find_layers()), all layers otherwise
+        """Render selected layers (use find_layers()), all layers otherwise.
+        Layers are stacked in this order. Only difference is rendered: not
+        selected visible layers are deleted (hidden if _RESIDENT), not visible
+        are created (shown if hidden), items of other visible layers are
+        untouched (only restacked if needed)
         """
         if layers is None:
             layers = self.ifind_layers("all")
-
-        # if rendering layers that already are rendered, nothing to do
-        # XXX '-' needs sorting (and additional lists)
-        # XXX '+' avoids canvas items recreation
-        sorted_layers = sorted(layers)
-        sorted_vilayers = sorted(self._vilayers)
-        if sorted_layers == sorted_vilayers:
+        # without duplicates, in order
+        seen = set()
+        layers = [l for l in layers if not (l in seen or seen.add(l))]
+        if layers == self._vilayers:
             # not rendering needed
             return
 
-        self.delete_visible()
+        selected = set(layers)
+        for l in self._vilayers:
+            if l not in selected:
+                try:
+                    if self._RESIDENT:
+                        l.hide()
+                    else:
+                        l.delete(really=False)
+                except:
+                    pass
         for l in layers:
-            l.render()
-            self._vilayers.append(l)
-            for tag in l.tags():
-                self.c.addtag_withtag(self.name, tag)
+            if not l.visible:
+                # hidden (resident) layer is only shown in it's place
+                created = not l.hidden
+                l.render()
+                if created:
+                    # on the top
+                    self._stack.append(l)
+                    for tag in l.tags():
+                        self.c.addtag_withtag(self.name, tag)
+        self._stack = [l for l in self._stack if l.visible or l.hidden]
+        self._vilayers = layers
+        if [l for l in self._stack if l.visible] != layers:
+            self._restack()
+
+    def _restack(self):
+        """Stack items of visible layers in order of _vilayers: each layer
+        just above previous one (position of the first is not changed)
+        """
+        prev = None
+        for l in self._vilayers:
+            for tag in collections.OrderedDict.fromkeys(l.tags()):
+                # tag of not flattened yet flat vlayer has not items
+                if not self.c.find_withtag(tag):
+                    continue
+                if prev is not None:
+                    self.c.tag_raise(tag, prev)
+                prev = tag
+        # hidden layers above the first visible are above all visible now
+        if self._vilayers and self._vilayers[0] in self._stack:
+            i = self._stack.index(self._vilayers[0])
+            self._stack = [l for l in self._stack[:i] if not l.visible] + \
+                    self._vilayers + [l for l in self._stack[i+1:] if not l.visible]
 
     def resize(self, event=None):
-        """On canvas resizing must be called"""
+        """On canvas resizing must be called (placing of shapes is debounced,
+        see GFigRender.resize())"""
         for l in self.find_layers("v*"): 
             l.gfr.resize(event)
 
+    def relayout(self, canw=None, canh=None):
+        """Place shapes of vlayers for canvas size canw x canh (actual if
+        None) now, see GFigRender.relayout()"""
+        for l in self.find_layers("v*"):
+            l.gfr.relayout(canw, canh)
+
+    def _bboxchanged(self, *a):
+        if self.bboxchanged is not None:
+            self.bboxchanged(self)
+
     def bbox(self):
         """Bound box (x0,y0,x1,y1) of all symbol (all are canvas coords)
         """
         bx0 = by0 = sys.maxint
         bx1 = by1 = 0
-        for l in self._rlayers:
-            if l.tag is None:
+        # bboxes are calculated (and cached by GFigRender), Tk is not called
+        bbs = [l.bbox() for l in self._rlayers] + \
+                [l.gfr.bbox() if l.visible else None for l in self._vlayers]
+        for bb in bbs:
+            if bb is None:
                 # invisible layer
                 continue
-            x0,y0,x1,y1 = self.c.bbox(l.tag)
+            x0,y0,x1,y1 = bb
             bx0 = min(bx0, x0)
             by0 = min(by0, y0)
             bx1 = max(bx1, x1)
             by1 = max(by1, y1)
-        for l in self._vlayers:
-            for sh in l.gfr.canvas_shapes:
-                if sh.tag is None:
-                    # invisible shape (not sure about vector shapes)
-                    continue
-                x0,y0,x1,y1 = self.c.bbox(sh.tag)
-                bx0 = min(bx0, x0)
-                by0 = min(by0, y0)
-                bx1 = max(bx1, x1)
-                by1 = max(by1, y1)
         return (bx0,by0,bx1,by1)
 
     def symcoords(self, canx, cany):
@@ -784,10 +1275,40 @@ if __name__ == "__main__":
     from pybase.tk import utils as tkutils
 
     if len(sys.argv) < 3:
-        print "arg: symbol-name root-dir"
+        print "arg: symbol-name root-dir | --precompile root-dir [symbol-name...] |"
+        print "     --thumbnails root-dir [symbol-name...]"
         print "Also symbol should contain 2-layers GIF file and two vector gfig files"
         sys.exit(0)
 
+    if sys.argv[1] == "--precompile":
+        SymModule.mount(unicode(sys.argv[2], sys.getfilesystemencoding()))
+        names = [unicode(a, sys.getfilesystemencoding()) for a in sys.argv[3:]] or None
+        t0 = time.time()
+        res = SymModule.precompile(names)
+        errors = [(n, e) for n,e in sorted(res.iteritems()) if e]
+        for n,e in errors:
+            print (u"%s: %s"%(n, e)).encode(sys.getfilesystemencoding(), "replace")
+        print "precompiled %d symbols in %.1f s, errors: %d"%(len(res) - len(errors),
+                time.time() - t0, len(errors))
+        sys.exit(1 if errors else 0)
+
+    if sys.argv[1] == "--thumbnails":
+        SymModule.mount(unicode(sys.argv[2], sys.getfilesystemencoding()))
+        names = [unicode(a, sys.getfilesystemencoding()) for a in sys.argv[3:]] or \
+                SymModule.names()
+        t0 = time.time()
+        nerrors = 0
+        for n in names:
+            try:
+                SymModule.thumbnail(n)
+            except Exception, x:
+                nerrors += 1
+                print (u"%s: %s"%(n, unicode(x) or repr(x))).encode(
+                        sys.getfilesystemencoding(), "replace")
+        print "thumbnails of %d symbols in %.1f s (in %s), errors: %d"%(len(names) - nerrors,
+                time.time() - t0, SymModule.THUMBDIR, nerrors)
+        sys.exit(1 if nerrors else 0)
+
     root = Tk()
     c = Canvas(root, bd=0)
     c.pack(fill=BOTH, expand=YES)
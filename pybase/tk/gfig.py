@@ -5,24 +5,36 @@
 #   - rectangles
 #   - polygons
 #   - arcs
-#   - old style spirals (via lines)
+#   - stars, spirals, Bezier curves (tessellated to polygons, lines)
 #   .. and it's outline-, fill- colors, line width; also polygon has
 # style ruby (recreate canvas object when changed - interesting effect
 # with smooth=1, ruby=True).
-# Not supported: Bezier, spiral, stars.
 # All unknown objects are ignored.
 
 # Transforming of objects is supported: move, scale, rotate. It's possible
 # to transform only one object or any selected objects of gfig-file. First,
 # shape class methods are used, for second, GFigRender methods are used.
 # GFigRender transformation methods has arg shapes - shapes to be transformed.
+# Transformations are composed in affine matrix (see pybase.geom) of shape and
+# applied to canvas item by one coords() call - immediately or, if GFigRender is
+# deferred, once per frame (when Tk is idle) or on commit(). If GFigRender is
+# queued, all updates of canvas items (configure(), labels, transformations)
+# are merged in CanvasQueue of canvas and sent to Tk by one Tcl script per frame.
+# Static layer can be flat GFigRender: it's shapes are rasterized with PIL in one
+# image item (see pybase.tk.raster) until user touches any of them. Without Tk,
+# gfig_image() renders file to PIL image (on ImageCanvas of pybase.tk.raster).
+# For shrunken layers (overview screens) GFigRender can use level of detail:
+# polylines, polygons are simplified to pixel tolerance, tiny shapes are hidden.
 # Also, you can select GFigRender shapes by find_shapes() method and process
 # it (transform, configure, for ex.). Finding use classname of shape ("CanvasArc",
 # "CanvasEllipse", etc) or any option (Tk cget, gfig option) in **kw form, or
 # name of shape. Usually shapes don't have names (gfig-extension feature), but
 # user can name each shape in order from left-to-right and top-to-bottom (canvas
 # location) with method name_shapes().
-# find_shapes() returns list, ifind_shapes() - iterator.
+# find_shapes() returns list, ifind_shapes() - iterator. Options are found in
+# inverted index (options set on creation and by configure() are known without
+# Tk, Tk defaults are asked), values are compared normalized, not exactly
+# (width=2 is the same as width="2.0", fill="RED" - as fill="red").
 
 # Each shape can have label - text short string. Technically, label is created on
 # first labelconfigure(), each other only changes label options. Label is placed
@@ -53,10 +65,18 @@
 # Author: P. Yosifov, 2010
 
 import itertools
+from array import array
 from pybase.gfig import *
+from pybase import geom
 from pybase.tk import utils as tkutils
 from pybase.utils import namedlist, minmax, dictdefaults
+try:
+    from pybase.tk import raster
+except ImportError:
+    raster = None # no PIL, so no flat GFigRender
 from Tkinter import *
+from Tkinter import _join, _flatten
+import cmath
 import math
 import sys
 import os
@@ -64,12 +84,140 @@ import re
 
 iround = lambda x, *a: int(round(x, *a))
 
+def normoption(value):
+    """Normalize value of canvas item option for comparison, bcz Tk
+    returns them as strings. Numbers are compared as floats, strings
+    without case and surrounding spaces (so it's not exact comparison):
+    >>> normoption(2) == normoption("2.0"), normoption("Red") == normoption("red")
+    (True, True)
+    >>> normoption((4, 2)) == normoption("4 2")
+    True
+    """
+    if isinstance(value, (tuple, list)):
+        value = u" ".join(unicode(v) for v in value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    if isinstance(value, basestring):
+        return value.strip().lower()
+    return value
+
 # TODO not one tag but list of tags in self.tag = __create__ - for complex figures
 # but may be it's bad idea?
 
 # XXX Instead of return dict in __create__ is possible to create LazyCanvas and
 # translate some methods calling (lazy) to dict
 
+# CanvasQueue {{{
+
+class CanvasQueue:
+    """Queue of canvas items updates: coords and options are kept per item
+    (last value of option wins) and are sent to Tk once, when Tk is idle or
+    on flush(), by one Tcl call. So cost of many updates of the same items
+    is only the cost of changed items. Failed updates don't stop the others,
+    they are reported (see report()). One queue per canvas, see of()
+    """
+    # Tcl proc: evaluates list of commands, returns list of failed commands
+    # with their error messages
+    _BATCH = "::pybase::gfig::batch"
+    _BATCHPROC = """namespace eval ::pybase::gfig {}
+proc %s {cmds} {
+    set errors {}
+    foreach cmd $cmds {
+        if {[catch {uplevel #0 $cmd} msg]} {
+            lappend errors $cmd $msg
+        }
+    }
+    return $errors
+}"""%_BATCH
+
+    def __init__(self, canvas):
+        self.c = canvas
+        self._coords = {} # {item: coords}
+        self._options = {} # {item: {option: value}}
+        self._before = [] # functions to call before flush()
+        self._after = None # id of after_idle() for flush()
+        canvas.tk.eval(self._BATCHPROC)
+
+    @staticmethod
+    def of(canvas):
+        """Returns queue of canvas (creates on first call)"""
+        q = getattr(canvas, "_gfig_queue", None)
+        if q is None:
+            q = canvas._gfig_queue = CanvasQueue(canvas)
+        return q
+
+    def __len__(self):
+        return len(set(self._coords).union(self._options))
+
+    def _schedule(self):
+        if self._after is None:
+            self._after = self.c.after_idle(self.flush)
+
+    def coords(self, item, *coords):
+        """Like Canvas coords() but only set"""
+        self._coords[item] = coords
+        self._schedule()
+
+    def itemconfigure(self, item, **kw):
+        """Like Canvas itemconfigure() but only set"""
+        if kw:
+            self._options.setdefault(item, {}).update(kw)
+            self._schedule()
+
+    def before_flush(self, func):
+        """Call func (without args) once before next flush, func may
+        update items (for ex., deferred transformations). Returns func
+        for cancel_before()
+        """
+        if func not in self._before:
+            self._before.append(func)
+        self._schedule()
+        return func
+
+    def cancel_before(self, func):
+        if func in self._before:
+            self._before.remove(func)
+
+    def discard(self, item):
+        """Forget updates of item (it's deleted)"""
+        self._coords.pop(item, None)
+        self._options.pop(item, None)
+
+    def flush(self):
+        """Send all updates to Tk"""
+        if self._after is not None:
+            self.c.after_cancel(self._after)
+            self._after = None
+        while self._before:
+            self._before.pop(0)()
+        if not self._coords and not self._options:
+            return
+        coords, self._coords = self._coords, {}
+        options, self._options = self._options, {}
+        cmds = []
+        for item, c in coords.iteritems():
+            cmds.append(_join((self.c._w, "coords", item) + _flatten(c)))
+        for item, kw in options.iteritems():
+            cmds.append(_join((self.c._w, "itemconfigure", item) + self.c._options(kw)))
+        # each command is caught, so failed one does not drop the others
+        errors = self.c.tk.splitlist(self.c.tk.call(self._BATCH, tuple(cmds)))
+        if errors:
+            self.report(zip(errors[::2], errors[1::2]))
+
+    def report(self, errors):
+        """Called by flush() with list of (command, message) of failed
+        updates. Reports them as error of Tk callback (see Tk
+        report_callback_exception), other updates are done anyway
+        """
+        try:
+            raise TclError(u"; ".join(u"%s: %s"%e for e in errors))
+        except TclError:
+            self.c._report_exception()
+
+# }}}
+
 # BaseCanvasShape {{{
 
 class BaseCanvasShape:
@@ -91,6 +239,40 @@ class BaseCanvasShape:
         self.user_styles = {} # kept for full recreation (now really is only reconfig, not recreate)
         # a special (not Tk) styles of label
         self.label_styles = {"side": N, "padx":0, "pady":0}
+        self._labelstate = NORMAL # state of label set by user
+        # pending transformation (matrix, see pybase.geom) and width of
+        # out-line, they are applied to canvas item on commit()
+        self._m = None
+        self._width = None
+        # when is set (by owner), is called with self on transformation
+        # instead of immidiatly commit() - to commit later
+        self.defer = None
+        # bbox of canvas item is calculated here, not in Tk (see bbox())
+        self._extent = None # extent of coords of canvas item
+        self._itemwidth = 1. # width of out-line of canvas item
+        self._bbox = None
+        # when is set (by owner), is called with self when bbox is changed
+        self.bboxchanged = None
+        # options of canvas item which were set (on creation, by configure()),
+        # they are known without Tk calling (see options())
+        self._options = {}
+        # when is set (by owner), is called with self when options are changed
+        self.optionschanged = None
+        # when is set (by owner) to CanvasQueue, canvas items are updated
+        # via it
+        self.queue = None
+        # when is set (by owner), is called with self before shape is
+        # changed by user (configured, transformed...)
+        self.touched = None
+        # when is set (by owner) to (tolerance, minsize) in pixels, coords
+        # of canvas item are simplified (see _lodcoords()) and item is hidden
+        # while it's smaller than minsize
+        self.lod = None
+        self._lodcache = {} # {zoom bucket: indexes of kept points}
+        self._lodhidden = False
+        # when is set (by sethidden()), canvas item and label are hidden
+        # whatever state they have
+        self.hidden = False
 
     _cre_width = re.compile(u"\((\d+)\)")
     def __gfig_styles__(self, shape):
@@ -144,11 +326,181 @@ class BaseCanvasShape:
     def create(self):
         """General method of creation canvas object"""
         creation = self.__create__()
-        styles = self.__styles__()
-        styles.update(creation.get("kw", {}))
         if creation:
-            self.tag = creation["func"](*creation["a"], **styles)
+            styles = self.__styles__()
+            styles.update(creation.get("kw", {}))
+            self.tag = creation["func"](*self._lodcoords(creation["a"]), **styles)
+            self._lodhidden = False
             self.c.addtag_withtag(self.grptag, self.tag)
+            self._setextent(creation["a"], styles)
+            self._setoptions(styles, reset=True)
+
+    # Bounding box {{{
+
+    BBOXFUDGE = 0 # additional pixels of Tk bbox (lines, polygons have 1)
+
+    def __extent__(self, coords, options):
+        """Returns extent (x0, y0, x1, y1) of canvas item created with
+        coords and options (without out-line width). Successor can overload
+        this if canvas item is not bounded by coords
+        """
+        xs = coords[0::2]
+        ys = coords[1::2]
+        return (min(xs), min(ys), max(xs), max(ys))
+
+    def _setextent(self, coords, options):
+        """Canvas item was created/changed with coords and options"""
+        if "width" in options:
+            self._setwidth(options["width"])
+        self._extent = self.__extent__(coords, options)
+        if self.lod is not None:
+            self._lodhide()
+        self._bboxchanged()
+
+    def _setwidth(self, width):
+        """Width of out-line of canvas item was changed"""
+        try:
+            self._itemwidth = float(width)
+        except (TypeError, ValueError):
+            # screen distance like '2m', so ask Tk
+            self._flush()
+            self._itemwidth = float(self.c.itemcget(self.tag, "width"))
+        self._bboxchanged()
+
+    def _bboxchanged(self):
+        self._bbox = None
+        if self.bboxchanged is not None:
+            self.bboxchanged(self)
+
+    def bbox(self):
+        """Bound box (x0,y0,x1,y1) of canvas item or None if there is
+        no item. It's like Tk Canvas bbox() (may differ by pixel) but is
+        calculated from known coords, without Tk calling, and is cached
+        """
+        self.commit()
+        if self.tag is None or self._extent is None:
+            return None
+        if self._bbox is None:
+            m = int(math.ceil(self._itemwidth/2.)) + self.BBOXFUDGE
+            x0, y0, x1, y1 = self._extent
+            self._bbox = (iround(x0) - m, iround(y0) - m, iround(x1) + m, iround(y1) + m)
+        return self._bbox
+
+    # }}}
+
+    # Canvas items updating {{{
+
+    def _coords(self, tag, *coords):
+        if self.queue is None:
+            self.c.coords(tag, *coords)
+        else:
+            self.queue.coords(tag, *coords)
+
+    def _itemconfigure(self, tag, **kw):
+        if self.queue is None:
+            self.c.itemconfigure(tag, **kw)
+        else:
+            self.queue.itemconfigure(tag, **kw)
+
+    def _flush(self):
+        """Send queued updates to Tk before asking it"""
+        if self.queue is not None:
+            self.queue.flush()
+
+    def _touch(self):
+        if self.touched is not None:
+            self.touched(self)
+
+    # }}}
+
+    # Level of detail {{{
+
+    # NOTE Points of polyline (polygon) are simplified with tolerance in
+    # pixels for current coords (they are on the screen already). Indexes of
+    # kept points are cached per zoom bucket - size of shape (length of
+    # polyline) in steps of sqrt(2), they don't depend on moving, rotation,
+    # so returning to zoom level does not need simplification
+
+    LOD = None # "line" or "polygon" if coords of item can be simplified
+
+    def _lodcoords(self, coords):
+        """coords of canvas item simplified for LOD (if it's set)"""
+        if self.lod is None or self.LOD is None or len(coords) < 6:
+            return coords
+        length = 0.
+        for i in xrange(0, len(coords) - 2, 2):
+            length += math.hypot(coords[i+2] - coords[i], coords[i+3] - coords[i+1])
+        if not length:
+            return coords
+        bucket = (len(coords), int(math.floor(2*math.log(length, 2))))
+        try:
+            indexes = self._lodcache[bucket]
+        except KeyError:
+            indexes = geom.simplify(coords, self.lod[0], self.LOD == "polygon")
+            self._lodcache[bucket] = indexes
+        if 2*len(indexes) == len(coords):
+            return coords
+        return [c for i in indexes for c in (coords[2*i], coords[2*i+1])]
+
+    def _lodhide(self):
+        """Hide canvas item if it's smaller than LOD minsize, show if not"""
+        x0, y0, x1, y1 = self._extent
+        hidden = max(x1 - x0, y1 - y0) < self.lod[1]
+        if hidden != self._lodhidden and self.tag is not None:
+            self._lodhidden = hidden
+            self._itemconfigure(self.tag, state=self._state())
+
+    # }}}
+
+    # Visibility {{{
+
+    def _state(self):
+        """State of canvas item: hidden by owner or LOD, else user state"""
+        if self.hidden or self._lodhidden:
+            return HIDDEN
+        return self.user_styles.get("state", NORMAL)
+
+    def sethidden(self, hidden):
+        """Hide canvas item and label without deletion (if hidden), or show
+        them in their own state. Shape is not touched
+        """
+        if hidden == self.hidden:
+            return
+        self.hidden = hidden
+        if self.tag is not None:
+            self._itemconfigure(self.tag, state=self._state())
+        if self.labeltag is not None:
+            self._itemconfigure(self.labeltag, state=HIDDEN if hidden else self._labelstate)
+
+    # }}}
+
+    # Options {{{
+
+    def _setoptions(self, options, reset=False):
+        """Options of canvas item were set (if reset, then only they are)"""
+        if reset:
+            self._options = dict(options)
+        elif all(k in self._options and self._options[k] == v
+                for k,v in options.iteritems()):
+            return
+        else:
+            self._options.update(options)
+        self._optionschanged()
+
+    def _optionschanged(self):
+        if self.optionschanged is not None:
+            self.optionschanged(self)
+
+    def options(self):
+        """Known options as dict: options of canvas item set on creation and
+        by configure() and gfig styles. Tk is not called, so options set
+        directly on canvas are not here (use cget() for them)
+        """
+        ret = dict(self._options)
+        ret.update(self.gfig_styles)
+        return ret
+
+    # }}}
 
     # NOTE If I will need to reimplement it via delete()/create() new
     # I'll have to keep user_styles (and gfig_styles?) - this is the
@@ -157,13 +509,16 @@ class BaseCanvasShape:
         """Like create
         """
         if self.tag is not None:
-            self.c.coords(self.tag, *coords)
+            self._coords(self.tag, *self._lodcoords(coords))
             # FIXME In some mail list there is the info that itemconfigure()
             # acomplish to Tk memory leak???
-            self.c.itemconfigure(self.tag, **options)
+            if options:
+                self._itemconfigure(self.tag, **options)
+                self._setoptions(options)
+            self._setextent(coords, options)
         if self.labeltag is not None:
             labx, laby = self._align_label()
-            self.c.coords(self.labeltag, labx, laby)
+            self._coords(self.labeltag, labx, laby)
 
     # XXX I'm not sure
 #    def __del__(self):
@@ -175,11 +530,18 @@ class BaseCanvasShape:
     def delete(self):
         """Delete canvas object from canvas"""
         if self.labeltag is not None:
+            if self.queue is not None:
+                self.queue.discard(self.labeltag)
             self.c.delete(self.labeltag)
             self.labeltag = None # no items - no tag
         if self.tag is not None:
+            if self.queue is not None:
+                self.queue.discard(self.tag)
             self.c.delete(self.tag)
             self.tag = None # no items - no tag
+            self._extent = None
+            self._bboxchanged()
+            self._setoptions({}, reset=True)
 
     # Label methods {{{
 
@@ -193,7 +555,7 @@ class BaseCanvasShape:
         side = self.label_styles["side"] if side is None else side
         padx = self.label_styles["padx"] if padx is None else padx
         pady = self.label_styles["pady"] if pady is None else pady
-        bx0, by0, bx1, by1 = self.c.bbox(self.tag)
+        bx0, by0, bx1, by1 = self.bbox()
         bx0 += padx
         by0 += pady
         return tkutils.anchor_coords(bx0, by0, bx1, by1, side)
@@ -208,6 +570,7 @@ class BaseCanvasShape:
         """
         if kw:
             # set options
+            self._touch()
             side = kw.pop("side", None)
             padx = kw.pop("padx", None)
             pady = kw.pop("pady", None)
@@ -231,16 +594,23 @@ class BaseCanvasShape:
             if not changed:
                 # avoid setting of attrs that already has the same values
                 return
+            if "state" in kw:
+                self._labelstate = kw["state"]
+                if self.hidden:
+                    kw["state"] = HIDDEN
 
             x, y = self._align_label(side, padx, pady) # and saved label styles
             if self.labeltag is None:
+                if self.hidden:
+                    kw["state"] = HIDDEN
                 self.labeltag = self.c.create_text(x, y, **kw)
             else:
-                self.c.coords(self.labeltag, x, y)
-                self.c.itemconfigure(self.labeltag, **kw)
+                self._coords(self.labeltag, x, y)
+                self._itemconfigure(self.labeltag, **kw)
         else:
             # get options
             if self.labeltag:
+                self._flush()
                 ret = self.c.itemconfigure(self.labeltag)
                 ret.update(self.label_styles)
                 return ret
@@ -252,6 +622,7 @@ class BaseCanvasShape:
         if optname in self.label_styles:
             return self.label_styles[optname]
         elif self.labeltag:
+            self._flush()
             return self.c.itemcget(self.labeltag, optname)
         else:
             raise ValueError(u"label was not created")
@@ -260,94 +631,117 @@ class BaseCanvasShape:
 
     # Transformation methods {{{
 
-    def move(self, xoff, yoff):
-        """Move by X-offset and Y-offset"""
-        self.s.points = [(p[0]+xoff, p[1]+yoff) for p in self.s.points]
+    # NOTE Transformations are composed in pending matrix and applied by one
+    # coords() call in commit(): immidiatly or later, if defer is set
+
+    def _compose(self, m, widthfactor=None):
+        """Compose pending transformation with matrix m, if widthfactor,
+        then width of out-line will be scaled (minimal is 1 pixel)
+        """
+        self._m = m if self._m is None else geom.compose(self._m, m)
+        if widthfactor is not None and self.tag is not None:
+            w = self._width
+            if w is None:
+                w = self._itemwidth
+            self._width = max(1, w * widthfactor)
+
+    def _changed(self):
+        """Commit now or later (defer)"""
+        if self.defer is None:
+            self.commit()
+        else:
+            self.defer(self)
+
+    def transform(self, m, widthfactor=None):
+        """Transform by affine matrix m (see pybase.geom). If widthfactor,
+        then width of out-line will be scaled (minimal is 1 pixel)
+        """
+        self._touch()
+        self._compose(m, widthfactor)
+        self._changed()
+
+    def commit(self):
+        """Apply pending transformations: points of shape are transformed
+        and canvas item is updated once
+        """
+        if self._m is None and self._width is None:
+            return
+        if self._m is not None and not geom.isidentity(self._m):
+            if isinstance(self.s.coords, array):
+                self.s.coords = geom.apply(self._m, self.s.coords)
+            else:
+                # view of GeomStore (see GFigRender), so in place
+                geom.iapply(self._m, self.s.coords)
+        width = self._width
+        self._m = self._width = None
         creation = self.__create__()
         if creation:
-            self.recreate(*creation["a"], **creation.get("kw", {}))
+            kw = creation.get("kw", {})
+            if width is not None:
+                kw["width"] = width
+            self.recreate(*creation["a"], **kw)
+
+    def move(self, xoff, yoff):
+        """Move by X-offset and Y-offset"""
+        self.transform(geom.translate(xoff, yoff))
 
     def flip(self, axe, axe_point=0):
         """Flip regarding axe 'x'|'y', axe_point - is coordinate
         of axe (need only one)
         """
         if axe in ("x", "X"):
-            self.s.points = [(p[0], -p[1] + 2*axe_point) for p in self.s.points]
+            self.transform(geom.scale(1, -1, 0, axe_point))
         elif axe in ("y", "Y"):
-            self.s.points = [(-p[0] + 2*axe_point, p[1]) for p in self.s.points]
+            self.transform(geom.scale(-1, 1, axe_point, 0))
         else:
             raise ValueError(u"axe must be 'x' or 'y'")
-        creation = self.__create__()
-        if creation:
-            self.recreate(*creation["a"], **creation.get("kw", {}))
 
     def xscale(self, factor, axe_point=0, widthscale=False):
         """Scale by factor by 0x, it's coords are specified by axe_point. Instead of
         coordinate, axe_point can be LEFT|RIGHT. If widthscale,
         then width of out-line will be scaled (minimal is 1 pixel)
         """
-        bx0,by0,bx1,by1 = self.c.bbox(self.tag)
-        if axe_point==LEFT:
-            axe_point = bx0
-        elif axe_point==RIGHT:
-            axe_point = bx1
-            
-        self.s.points = [(axe_point + (p[0]-axe_point)*factor, p[1]) for p in self.s.points]
-        creation = self.__create__()
-        if creation:
-            if widthscale:
-                w = float(self.c.itemcget(self.tag, "width"))
-                w = max(1, w * factor)
-                creation.setdefault("kw", {})
-                creation["kw"]["width"] = w
-            self.recreate(*creation["a"], **creation.get("kw", {}))
+        if axe_point in (LEFT, RIGHT):
+            bx0,by0,bx1,by1 = self.bbox()
+            axe_point = bx0 if axe_point==LEFT else bx1
+        self.transform(geom.scale(factor, 1, axe_point, 0), factor if widthscale else None)
 
     def yscale(self, factor, axe_point=0, widthscale=False):
         """Scale by factor by 0y, it's coords are specified by axe_point. Instead of
         coordinate, axe_point can be TOP|BOTTOM. If widthscale,
         then width of out-line will be scaled (minimal is 1 pixel)
         """
-        bx0,by0,bx1,by1 = self.c.bbox(self.tag)
-        if axe_point==TOP:
-            axe_point = by0
-        elif axe_point==BOTTOM:
-            axe_point = by1
-            
-        self.s.points = [(p[0], axe_point + (p[1]-axe_point)*factor) for p in self.s.points]
-        creation = self.__create__()
-        if creation:
-            if widthscale:
-                w = float(self.c.itemcget(self.tag, "width"))
-                w = max(1, w * factor)
-                creation.setdefault("kw", {})
-                creation["kw"]["width"] = w
-            self.recreate(*creation["a"], **creation.get("kw", {}))
+        if axe_point in (TOP, BOTTOM):
+            bx0,by0,bx1,by1 = self.bbox()
+            axe_point = by0 if axe_point==TOP else by1
+        self.transform(geom.scale(1, factor, 0, axe_point), factor if widthscale else None)
 
     # XXX can not rotate rectangles, ovals (?), circles
     def rotate(self, x, y, angle):
         """Rotate shape about x,y on specified angle
         """
-        rangle = math.radians(angle)
-        def rotpair(p):
-            """rotate x,y (p is pair of x,y). From effbot.org:
-            'Tkinter Tricks:Using Complex Numbers to Rotate Canvas Items'"""
-            px = p[0] - x
-            py = p[1] - y
-            rx = px*math.cos(rangle) + py*math.sin(rangle)
-            ry = -px*math.sin(rangle) + py*math.cos(rangle)
-            return (rx+x, ry+y)
-
-        self.s.points = [rotpair(p) for p in self.s.points]
-        creation = self.__create__()
-        if creation:
-            self.recreate(*creation["a"], **creation.get("kw", {}))
+        self.transform(geom.rotate(angle, x, y))
 
     def place(self, x=None, y=None, relx=None, rely=None,
             width=None, height=None, relwidth=None, relheight=None, anchor=CENTER, widthscale=False):
-        """Like place in Tk but on canvas
+        """Like place in Tk but on canvas. Scaling and moving are
+        composed, so canvas item is updated once
         """
         canw = float(self.c.winfo_width())
         canh = float(self.c.winfo_height())
+        self.commit()
+        m, widthfactor = self.placement(self.bbox(), canw, canh, x=x, y=y,
+                relx=relx, rely=rely, width=width, height=height, relwidth=relwidth,
+                relheight=relheight, anchor=anchor, widthscale=widthscale)
+        self.transform(m, widthfactor)
+
+    @staticmethod
+    def placement(bbox, canw, canh, x=None, y=None, relx=None, rely=None,
+            width=None, height=None, relwidth=None, relheight=None, anchor=CENTER, widthscale=False):
+        """Returns (matrix, widthfactor) of placing (see place()) of shape with
+        bbox on canvas with size canw x canh. widthfactor is None if not
+        widthscale
+        """
         if relx is not None:
             x = canw * relx
         if rely is not None:
@@ -357,22 +751,32 @@ class BaseCanvasShape:
         if relheight is not None:
             height = canh * relheight
 
-        bx0, by0, bx1, by1 = self.c.bbox(self.tag)
+        bx0, by0, bx1, by1 = bbox
+        m = geom.IDENTITY
+        widthfactor = None
 
-        # first, change size
+        # first, change size (left, top sides are not moved)
 
         if width:
             oldw = abs(bx1-bx0) or 1.
-            self.xscale(factor=width/oldw, axe_point=LEFT, widthscale=widthscale)
+            factor = width/oldw
+            m = geom.compose(m, geom.scale(factor, 1, bx0, 0))
+            if widthscale:
+                widthfactor = factor
         if height:
             oldh = abs(by1-by0) or 1.
-            self.yscale(factor=height/oldh, axe_point=TOP, widthscale=widthscale)
+            factor = height/oldh
+            m = geom.compose(m, geom.scale(1, factor, 0, by0))
+            if widthscale:
+                widthfactor = factor if widthfactor is None else widthfactor*factor
 
         # second, move
 
-        # Anchor coords: anchor is point inside this bound-box. Moving needs
-        # shifting by the anchor coords (inside bbox) after usual movement.
-        ax,ay = tkutils.anchor_coords(0, 0, bx1-bx0, by1-by0, anchor)
+        # Anchor coords: anchor is point inside this bound-box (already
+        # scaled). Moving needs shifting by the anchor coords (inside bbox)
+        # after usual movement.
+        sx0, sy0, sx1, sy1 = geom.apply(m, (bx0, by0, bx1, by1))
+        ax,ay = tkutils.anchor_coords(0, 0, sx1-sx0, sy1-sy0, anchor)
 
         if x is not None and x != bx0:
             xoff = x - bx0 - ax
@@ -384,9 +788,9 @@ class BaseCanvasShape:
         else:
             yoff = 0
 
-        #print "[%s] bx0: %d ax: %d xoff: %d canw: %d" % (self.tag, bx0, ax, xoff, canw)
         if xoff or yoff:
-            self.move(xoff, yoff)
+            m = geom.compose(m, geom.translate(xoff, yoff))
+        return m, widthfactor
 
     # }}}
 
@@ -398,23 +802,37 @@ class BaseCanvasShape:
             # already exists canvas item
             if not kw:
                 # obtain options, not set
+                self._flush()
                 ret = self.c.itemconfigure(self.tag)
                 ret.update(self.gfig_styles)
                 return ret
             else:
+                self._touch()
                 changed = False
+                gfig_changed = False
                 # set new values for options
                 for k,v in kw.iteritems():
                     if k.startswith("gfig_"):
-                        self.gfig_styles[k] = v
+                        if self.gfig_styles.get(k) != v:
+                            self.gfig_styles[k] = v
+                            gfig_changed = True
                     else:
                         if self.user_styles.get(k) != v:
                             self.user_styles[k] = v
                             changed = True
+                if gfig_changed:
+                    self._optionschanged()
                 if not changed:
                     # avoid setting of attrs that already has the same values
                     return
-                self.c.itemconfigure(self.tag, **self.user_styles)
+                options = self.user_styles
+                if "state" in options:
+                    # hidden by owner or LOD wins
+                    options = dict(options, state=self._state())
+                self._itemconfigure(self.tag, **options)
+                self._setoptions(self.user_styles)
+                if "width" in kw:
+                    self._setwidth(kw["width"])
         else:
             # canvas item not exists, so returns gfig_styles
             return self.gfig_styles
@@ -425,6 +843,7 @@ class BaseCanvasShape:
         if optname in self.gfig_styles:
             return self.gfig_styles[optname]
         else:
+            self._flush()
             return self.c.itemcget(self.tag, optname)
 
 # }}}
@@ -434,9 +853,9 @@ class BaseCanvasShape:
 # name like CanvasSomething, where Something #
 # is the name of gfig element (shape.name)   #
 #                                            #
-# Seems to be impossible to create Bezier,   #
-# and spiral (may be via arcs?), starts are  #
-# omitted                                    #
+# There are no Tk items for Bezier, spiral   #
+# and star, so they are tessellated to       #
+# polygons, lines (see TessellatedShape)     #
 #--------------------------------------------#
 
 # Canvas concrete shapes {{{
@@ -445,6 +864,9 @@ class CanvasIgnoredShape(BaseCanvasShape):
     pass
 
 class CanvasLine(BaseCanvasShape):
+    BBOXFUDGE = 1
+    LOD = "line"
+
     def __create__(self):
         p = list(itertools.chain(*self.s.points))
         return dict(func=self.c.create_line, a=p)
@@ -484,6 +906,9 @@ class CanvasRectangle(BaseCanvasShape):
         return dict(func=self.c.create_rectangle, a=p)
 
 class CanvasPoly(BaseCanvasShape):
+    BBOXFUDGE = 1
+    LOD = "polygon"
+
     def __init__(self, shape, grptag, canvas, ruby=False):
         """ruby style shows polygon as ruby
         """
@@ -501,6 +926,7 @@ class CanvasPoly(BaseCanvasShape):
         else:
             # set ruby or kw
             if ruby is not None:
+                self._touch()
                 self.delete()
                 self.__points = self.__ruby_points if ruby else self.__solid_points
                 self.create()
@@ -512,50 +938,62 @@ class CanvasPoly(BaseCanvasShape):
         p = self.__points()
         return dict(func=self.c.create_polygon, a=p)
 
+    def _lodcoords(self, coords):
+        if self.ruby:
+            # lines between vertices, not polygon
+            return coords
+        return BaseCanvasShape._lodcoords(self, coords)
+
+    # NOTE Vertices are the vertex point (r*) rotated about the center (c*)
+    # on i*2pi/nsegs. Cosines, sines of these angles are cached per nsegs
+    # (_unitpolys), offsets of vertices from the center - per shape (_offsets),
+    # so moving of polygon does not need any trigonometry
+
+    _unitpolys = {} # {nsegs: [(cos, sin) of angles of vertices]}
+
+    @staticmethod
+    def _unitpoly(nsegs):
+        """Vertices of unit polygon with nsegs segments"""
+        try:
+            return CanvasPoly._unitpolys[nsegs]
+        except KeyError:
+            dang = 2*math.pi/nsegs # delta of angle (step)
+            ret = [(math.cos(i*dang), math.sin(i*dang)) for i in xrange(nsegs)]
+            CanvasPoly._unitpolys[nsegs] = ret
+            return ret
+
+    _offsets = (None, None) # ((nsegs, rx - cx, ry - cy), offsets of vertices)
+
+    def __vertices(self):
+        """Returns nsegs, vertex point and offsets of all vertices (from
+        the center)
+        """
+        # there are 2 points: center (c*) and other point on vertex (r*)
+        nsegs = int(self.s.extra[0])
+        cx, cy, rx, ry = self.s.coords[:4]
+        key = (nsegs, rx - cx, ry - cy)
+        if self._offsets[0] != key:
+            _, norm_rx, norm_ry = key # r in normal coords (center is (0,0))
+            offsets = [(norm_rx*cos - norm_ry*sin, norm_rx*sin + norm_ry*cos)
+                    for cos, sin in self._unitpoly(nsegs)]
+            self._offsets = (key, offsets)
+        return cx, cy, rx, ry, self._offsets[1]
+
     def __solid_points(self):
         """points for solid style (non-ruby)"""
-        # there are 2 points: center (c*) and other point on
-        # vertex (r*)
-        nsegs = int(self.s.extra[0])
-        cx,cy = self.s.points[0]
-        rx,ry = self.s.points[1]
-        # center must be (0,0) for normal polar coords. But
-        # it's not, so there is coords shifting on (cx, cy)
-        norm_rx = rx - cx # rx in normal coords (without shifting)
-        norm_ry = ry - cy # ry in normal coords (without shifting)
-        dang = 2*math.pi/nsegs # delta of angle (step)
-        R = math.sqrt(norm_rx**2 + norm_ry**2) # radious
-        rang = math.atan2(norm_ry, norm_rx) # angle of polar coords of r
+        cx, cy, rx, ry, offsets = self.__vertices()
         res = [rx, ry]
-        for i in xrange(1, nsegs):
-            ang = i*dang + rang
-            x = iround(R * math.cos(ang) + cx)
-            y = iround(R * math.sin(ang) + cy)
-            res.extend((x, y))
+        for x, y in itertools.islice(offsets, 1, None):
+            res.extend((iround(x + cx), iround(y + cy)))
         return res
 
     # This method is contrib. from gfig.c
     def __ruby_points(self):
         """points for ruby-style"""
-        # there are 2 points: center (c*) and other point on
-        # vertex (r*)
-        nsegs = int(self.s.extra[0])
-        cx,cy = self.s.points[0]
-        rx,ry = self.s.points[1]
-        shift_x = rx - cx
-        shift_y = ry - cy
-        R = math.sqrt(shift_x**2 + shift_y**2)
-        ang_grid = 2*math.pi/nsegs
-        offset_angle = math.atan2(shift_y, shift_x)
-
+        cx, cy, rx, ry, offsets = self.__vertices()
         do_line = False
         res = []
-        for loop in xrange(nsegs):
-            ang_loop = loop*ang_grid + offset_angle
-
-            lx = R * math.cos(ang_loop)
-            ly = R * math.sin(ang_loop)
-
+        for lx, ly in offsets:
             calc_x = iround(lx + cx)
             calc_y = iround(ly + cy)
 
@@ -573,7 +1011,37 @@ class CanvasPoly(BaseCanvasShape):
         return res
 
 class CanvasArc(BaseCanvasShape):
-    def __create__(self):
+    # NOTE Geometry of arc (circle, angles of 3 points) is cached per shape
+    # (_geom) relative to the 1st point. When points are moved, rotated or
+    # scaled uniformly (transformation is similarity), cached geometry is
+    # transformed too, without solving of system
+
+    _geom = None # (p2 - p1, p3 - p1, center - p1, R, [ang1, ang2, ang3]), complex
+
+    def __geometry(self):
+        """Returns center (complex), radius and angles (degrees, 0..360)
+        of 3 points of arc
+        """
+        x1, y1, x2, y2, x3, y3 = self.s.coords[:6]
+        p1 = complex(x1, y1)
+        u = complex(x2, y2) - p1
+        v = complex(x3, y3) - p1
+        g = self._geom
+        if g is not None:
+            gu, gv, gc, gR, gangs = g
+            if u == gu and v == gv:
+                return p1 + gc, gR, gangs
+            if gu:
+                z = u/gu # rotation and scaling (complex multiplication)
+                if abs(v - z*gv) <= 1e-9*abs(v):
+                    # Y axe is down, so positive phase is clockwise
+                    dang = math.degrees(cmath.phase(z))
+                    c = z*gc
+                    R = abs(z)*gR
+                    angs = [(a - dang)%360. for a in gangs]
+                    self._geom = (u, v, c, R, angs)
+                    return p1 + c, R, angs
+
         # points are coords of 3 points on arc:
         # 2 on edges and one in center of the arc
 
@@ -585,10 +1053,6 @@ class CanvasArc(BaseCanvasShape):
         # difference between 1st, 3rd for cy calculation. After
         # calculation of cx,cy it's trivial to find R (see circle equation).
 
-        x1, y1 = (float(x) for x in self.s.points[0])
-        x2, y2 = (float(x) for x in self.s.points[1])
-        x3, y3 = (float(x) for x in self.s.points[2])
-
         cx = (-x1**2 + x2**2 - y1**2 + y2**2 + (x1**2 - x3**2 + y1**2 - y3**2)*(y1 - y2)/(y1 - y3))/ \
                 (-2*(x1 - x2 - (x1 - x3)*(y1 - y2)/(y1 - y3)))
 
@@ -596,29 +1060,19 @@ class CanvasArc(BaseCanvasShape):
 
         R = math.sqrt((x1 - cx)**2 + (y1 - cy)**2)
 
-        p0 = (cx-R, cy-R)
-        p1 = (cx+R, cy+R)
-
         # contrib. from gfig.c
-        norm_x1 = x1 - cx
-        norm_y1 = -y1 + cy
-        norm_x2 = x2 - cx
-        norm_y2 = -y2 + cy
-        norm_x3 = x3 - cx
-        norm_y3 = -y3 + cy
-        ang1 = math.atan2(norm_y1, norm_x1)
-        ang2 = math.atan2(norm_y2, norm_x2)
-        ang3 = math.atan2(norm_y3, norm_x3)
-
-        if ang1 < 0:
-            ang1 += 2*math.pi
-        if ang2 < 0:
-            ang2 += 2*math.pi
-        if ang3 < 0:
-            ang3 += 2*math.pi
-        ang1 = math.degrees(ang1)
-        ang2 = math.degrees(ang2)
-        ang3 = math.degrees(ang3)
+        angs = []
+        for x, y in ((x1, y1), (x2, y2), (x3, y3)):
+            ang = math.atan2(-y + cy, x - cx)
+            if ang < 0:
+                ang += 2*math.pi
+            angs.append(math.degrees(ang))
+        self._geom = (u, v, complex(cx, cy) - p1, R, angs)
+        return complex(cx, cy), R, angs
+
+    def __create__(self):
+        c, R, (ang1, ang2, ang3) = self.__geometry()
+        cx, cy = c.real, c.imag
 
         maxang = ang1
         if ang3 > maxang:
@@ -631,12 +1085,9 @@ class CanvasArc(BaseCanvasShape):
         else:
             arcang = maxang - minang - 360
 
-        ang1 = iround(ang1)
         arcang = iround(arcang)
-        cx = iround(cx)
-        cy = iround(cy)
-        p0 = [iround(x) for x in p0]
-        p1 = [iround(x) for x in p1]
+        p0 = [iround(x) for x in (cx-R, cy-R)]
+        p1 = [iround(x) for x in (cx+R, cy+R)]
         return dict(func=self.c.create_arc, a=(p0[0], p0[1], p1[0], p1[1]), kw={"start":minang, "extent":arcang})
 
         # for debuging: edges nodes in blue and center in red
@@ -645,6 +1096,163 @@ class CanvasArc(BaseCanvasShape):
         #tkutils.create_canvas_cross(self.c, *self.s.points[1], width=2, fill="blue")
         #tkutils.create_canvas_cross(self.c, *self.s.points[2], width=2, fill="blue")
 
+    def __extent__(self, coords, options):
+        """Extent of arc (pieslice): center, edges of arc and extreme
+        points of oval which are on the arc
+        """
+        if "start" not in options or "extent" not in options:
+            return BaseCanvasShape.__extent__(self, coords, options)
+        x0, y0, x1, y1 = coords
+        cx = (x0 + x1)/2.
+        cy = (y0 + y1)/2.
+        rx = abs(x1 - x0)/2.
+        ry = abs(y1 - y0)/2.
+        start = float(options["start"])
+        extent = float(options["extent"])
+        if extent < 0:
+            start, extent = start + extent, -extent
+        angs = [start, start + extent]
+        # extreme points (0, 90, 180, 270 degrees) inside arc
+        ang = math.ceil(start/90.)*90
+        while ang < start + extent:
+            angs.append(ang)
+            ang += 90
+        xs = [cx] + [cx + rx*math.cos(math.radians(a)) for a in angs]
+        ys = [cy] + [cy - ry*math.sin(math.radians(a)) for a in angs]
+        return (min(xs), min(ys), max(xs), max(ys))
+
+class TessellatedShape(BaseCanvasShape):
+    """Base of shapes which are tessellated to polyline or polygon by
+    __tessellate__(). Tessellation is cached per shape: when control points
+    are moved, rotated or scaled uniformly (similarity), cached points are
+    transformed instead of new tessellation, while the scale keeps error
+    in tolerance (any scale if tessellation is EXACT)
+    """
+    BBOXFUDGE = 1
+    TOLERANCE = 0.25 # pixels, max. distance of tessellation from curve
+    EXACT = False # tessellation is exact (vertices of polygon)
+    ROTATABLE = True # tessellation of rotated control points is rotated
+
+    _tess = None # (control coords, tessellated coords, scale after tessellation)
+
+    def __tessellate__(self, coords):
+        """Returns flat coords (floats) of polyline/polygon for control
+        points coords. Successor must overload this
+        """
+        raise NotImplementedError
+
+    def _tessellated(self):
+        """Tessellated coords (cached)"""
+        key = tuple(self.s.coords)
+        if self._tess is not None:
+            old, points, scale = self._tess
+            if old == key:
+                return points
+            m = geom.similarity(old, key)
+            if m is not None and not self.ROTATABLE and (abs(m[1]) > 1e-9*abs(m[0]) or m[0] < 0):
+                m = None
+            if m is not None:
+                scale *= math.hypot(m[0], m[1])
+                if self.EXACT or 0.5 <= scale <= 1. + 1e-9:
+                    points = geom.apply(m, points)
+                    self._tess = (key, points, scale)
+                    return points
+        points = self.__tessellate__(self.s.coords)
+        self._tess = (key, points, 1.)
+        return points
+
+class CanvasStar(TessellatedShape):
+    """Star: polygon with extra[0] outer vertices (points: center, outer
+    and inner vertex)
+    """
+    LOD = "polygon"
+    EXACT = True
+
+    def __create__(self):
+        return dict(func=self.c.create_polygon, a=self._tessellated())
+
+    # contrib. from gfig.c
+    def __tessellate__(self, coords):
+        nsides = int(self.s.extra[0])
+        cx, cy, ox, oy, ix, iy = coords[:6]
+        outer_radius = math.hypot(ox - cx, oy - cy)
+        offset_angle = math.atan2(oy - cy, ox - cx)
+        inner_radius = math.hypot(ix - cx, iy - cy)
+        inner_offset_angle = math.atan2(iy - cy, ix - cx)
+        ang_grid = math.pi/nsides
+        res = []
+        for loop in xrange(2*nsides):
+            if loop%2:
+                ang_loop = loop*ang_grid + inner_offset_angle
+                radius = inner_radius
+            else:
+                ang_loop = loop*ang_grid + offset_angle
+                radius = outer_radius
+            res.extend((cx + radius*math.cos(ang_loop), cy + radius*math.sin(ang_loop)))
+        return res
+
+class CanvasSpiral(TessellatedShape):
+    """Archimedean spiral from center to radius point (points) with
+    extra[0] turns (negative - clockwise). It always starts in direction
+    of X axe, so it's not ROTATABLE
+    """
+    LOD = "line"
+    ROTATABLE = False
+
+    def __create__(self):
+        return dict(func=self.c.create_line, a=self._tessellated())
+
+    def __styles__(self):
+        return dict(fill=self.cget("gfig_fg"), width=self.cget("gfig_width"))
+
+    def __tessellate__(self, coords):
+        turns = int(self.s.extra[0]) if self.s.extra else 1
+        clockwise = -1 if turns < 0 else 1
+        cx, cy, rx, ry = coords[:4]
+        radius = math.hypot(rx - cx, ry - cy)
+        # in coords where spiral is counter-clockwise, ends in radius point
+        offset_angle = math.atan2(clockwise*(ry - cy), rx - cx)
+        if offset_angle < 0:
+            offset_angle += 2*math.pi
+        maxang = abs(turns)*2*math.pi + offset_angle
+        if not radius or not maxang:
+            return [cx, cy, rx, ry]
+        sp_cons = radius/maxang
+        # step of angle: chord of outer turn is closer than TOLERANCE
+        dang = 2*math.acos(max(-1., 1. - self.TOLERANCE/radius))
+        dang = min(dang, math.pi/8)
+        nsteps = int(math.ceil(maxang/dang))
+        res = []
+        for i in xrange(nsteps + 1):
+            ang = maxang*i/nsteps
+            r = sp_cons*ang
+            res.extend((cx + r*math.cos(ang), cy + clockwise*r*math.sin(ang)))
+        return res
+
+class CanvasBezier(TessellatedShape):
+    """Chain of cubic Bezier curves (see bezier() in pybase.geom), closed
+    (polygon) if extra[0] is not 0
+    """
+    LOD = "line" # closed has the same first and last points
+
+    def __init__(self, shape, grptag, canvas):
+        self.closed = bool(shape.extra and shape.extra[0])
+        BaseCanvasShape.__init__(self, shape, grptag, canvas)
+
+    def __create__(self):
+        func = self.c.create_polygon if self.closed else self.c.create_line
+        return dict(func=func, a=self._tessellated())
+
+    def __styles__(self):
+        if self.closed:
+            return BaseCanvasShape.__styles__(self)
+        return dict(fill=self.cget("gfig_fg"), width=self.cget("gfig_width"))
+
+    def __tessellate__(self, coords):
+        if self.closed:
+            coords = list(coords) + list(coords[:2])
+        return geom.bezier(coords, self.TOLERANCE)
+
 # }}}
 
 
@@ -653,18 +1261,274 @@ class CanvasArc(BaseCanvasShape):
 class GFigRender(GFigParser):
     """Render GFig file on canvas
     """
-    def __init__(self, canvas, encoding="utf8"):
+    def __init__(self, canvas, encoding="utf8", cache=None, deferred=False, geomstore=False,
+            queued=False, flat=False, lod=False):
+        """cache is the GFigCache of parsed files, is used when render()
+        file name (shared_cache from pybase.gfig is good choice). If deferred,
+        transformations of shapes are applied to canvas once per frame (when
+        Tk is idle) or on commit(). If geomstore and NumPy is available,
+        coordinates of all shapes are kept in one array (see GeomStore in
+        pybase.geom), so transformation of many shapes is vectorized. If
+        queued, updates of canvas items (coords, options, labels) are merged
+        in CanvasQueue of canvas and are sent to Tk once per frame. If flat
+        and PIL is available, shapes are shown as one image item (see
+        RasterCanvas in pybase.tk.raster) until any of them is touched
+        (configured, transformed itself...), then they become usual canvas
+        items; flat shapes are not queued. If lod, polylines and polygons
+        are simplified with LODTOLERANCE and shapes smaller than LODMINSIZE
+        are hidden (level of detail for shrunken layers)
+        """
+        GFigParser.__init__(self)
         self.name = "" # name and grptag
         self.c = canvas
         self.encoding = encoding
+        self.cache = cache
+        self.deferred = deferred
+        self.queue = CanvasQueue.of(canvas) if queued else None
+        self.lod = lod
+        self._raster = raster.RasterCanvas(canvas) if flat and raster is not None else None
         self.canvas_shapes = namedlist() # in Z-order: last is top
         self._placed_shapes = {} # {shape:kw for shape.place()}
+        # placing of shapes (see relayout()): {shape:[bbox before placing,
+        # canvas size used in placing, matrix of placing, widthfactor]}
+        self._layout = {}
+        self._resizeafter = None # id of after() for relayout()
+        self._pending = set() # shapes with not commited transformations
+        self._after = None # id of after_idle() (or queue before_flush()) for commit()
+        self.geomstore = geomstore
+        self._store = None # GeomStore, is created on first commit()
+        self._storeindex = {} # {shape:index in store}
+        self._bbox = None # cached bbox()
+        self._grid = None # spatial index of shapes (GridIndex), is created on search
+        self._dirty = set() # shapes with changed bbox (not updated in _grid)
+        # inverted index of shapes options (see _getoptindex()), is created on search
+        self._optindex = None # {(option, normalized value): set of shapes}
+        self._optshapes = {} # {option: set of shapes having it}
+        self._optentries = {} # {shape: (index in canvas_shapes, {option: normalized value})}
+        self._classindex = {} # {class name: set of shapes}
+        self._noitem = set() # shapes without canvas item (no options)
+        self._optdirty = set() # shapes with changed options (not updated in index)
+        # when is set (by owner), is called with self when bbox of any shape
+        # is changed
+        self.bboxchanged = None
+
+    RESIZEDELAY = 50 # ms without resize() before relayout()
+    LODTOLERANCE = 0.5 # pixels, max. distance of dropped points (if lod)
+    LODMINSIZE = 2 # pixels, smaller shapes are hidden (if lod)
 
     def resize(self, event=None):
-        """On canvas resizing, is called by owner of GFigRender"""
-        for sh,kw in self._placed_shapes.iteritems():
-            #print "place with", kw
-            sh.place(**kw)
+        """On canvas resizing, is called by owner of GFigRender. Bursts of
+        calls are debounced: shapes are placed once, RESIZEDELAY ms after
+        the last call
+        """
+        if self._resizeafter is not None:
+            self.c.after_cancel(self._resizeafter)
+        self._resizeafter = self.c.after(self.RESIZEDELAY, self.relayout)
+
+    def relayout(self, canw=None, canh=None, shapes=None):
+        """Place now shapes (all if None) placed by place() for canvas
+        size canw x canh (actual if None). Shape is placed from it's geometry
+        before the first placing, so only one transformation is done; shapes
+        which are placed relative to not changed canvas size are skipped.
+        When user changes shape (see BaseCanvasShape.touched), it's geometry
+        becomes new base of placing
+        """
+        if shapes is None and self._resizeafter is not None:
+            self.c.after_cancel(self._resizeafter)
+            self._resizeafter = None
+        if not self._placed_shapes:
+            return
+        if canw is None:
+            canw = float(self.c.winfo_width())
+        if canh is None:
+            canh = float(self.c.winfo_height())
+        if shapes is None:
+            shapes = self._placed_shapes.iterkeys()
+        for sh in shapes:
+            kw = self._placed_shapes[sh]
+            # canvas sizes on which placing depends
+            size = (canw if "relx" in kw or "relwidth" in kw else None,
+                    canh if "rely" in kw or "relheight" in kw else None)
+            lay = self._layout.get(sh)
+            if lay is None:
+                bbox = sh.bbox()
+                if bbox is None:
+                    continue
+                lay = self._layout[sh] = [bbox, None, geom.IDENTITY, 1.]
+            elif lay[1] == size:
+                continue
+            m, widthfactor = sh.placement(lay[0], canw, canh, **kw)
+            if widthfactor is None:
+                widthfactor = 1.
+            # undo previous placing and place again
+            sh._compose(geom.compose(geom.invert(lay[2]), m),
+                    widthfactor/lay[3] if widthfactor != lay[3] else None)
+            sh._changed()
+            lay[1:] = [size, m, widthfactor]
+
+    GRIDCELL = 64 # size of cell of spatial index
+
+    def _bboxchanged(self, shape):
+        self._bbox = None
+        if self._grid is not None:
+            self._dirty.add(shape)
+        if self.bboxchanged is not None:
+            self.bboxchanged(self)
+
+    def _getgrid(self):
+        """Returns actual spatial index of shapes, order of shape is
+        it's index in canvas_shapes (Z-order)
+        """
+        if self._pending:
+            self.commit()
+        if self._grid is None:
+            self._grid = geom.GridIndex(self.GRIDCELL)
+            for i,sh in enumerate(self.canvas_shapes):
+                self._grid.insert(sh, sh.bbox(), i)
+            self._dirty = set()
+        elif self._dirty:
+            dirty, self._dirty = self._dirty, set()
+            order = dict((sh, i) for i,sh in enumerate(self.canvas_shapes))
+            for sh in dirty:
+                if sh in order:
+                    self._grid.insert(sh, sh.bbox(), order[sh])
+        return self._grid
+
+    def _optionschanged(self, shape):
+        if self._optindex is not None:
+            self._optdirty.add(shape)
+
+    def _optindexshape(self, sh, order):
+        """(Re)index options of shape sh, order is it's index in canvas_shapes
+        """
+        if sh in self._optentries:
+            for k,v in self._optentries[sh][1].iteritems():
+                self._optindex[(k, v)].discard(sh)
+                self._optshapes[k].discard(sh)
+        entries = dict((k, normoption(v)) for k,v in sh.options().iteritems())
+        for k,v in entries.iteritems():
+            self._optindex.setdefault((k, v), set()).add(sh)
+            self._optshapes.setdefault(k, set()).add(sh)
+        self._optentries[sh] = (order, entries)
+        if sh.tag is None:
+            self._noitem.add(sh)
+        else:
+            self._noitem.discard(sh)
+
+    def _getoptindex(self):
+        """Returns actual inverted index of shapes options"""
+        if self._optindex is None:
+            self._optindex = {}
+            self._optshapes = {}
+            self._optentries = {}
+            self._classindex = {}
+            self._noitem = set()
+            for i,sh in enumerate(self.canvas_shapes):
+                self._classindex.setdefault(sh.__class__.__name__, set()).add(sh)
+                self._optindexshape(sh, i)
+            self._optdirty = set()
+        elif self._optdirty:
+            dirty, self._optdirty = self._optdirty, set()
+            for sh in dirty:
+                if sh in self._optentries:
+                    self._optindexshape(sh, self._optentries[sh][0])
+        return self._optindex
+
+    def bbox(self):
+        """Bound box (x0,y0,x1,y1) of all shapes (see BaseCanvasShape.bbox())
+        or None if there are not canvas items. It's cached
+        """
+        if self._pending:
+            self.commit()
+        if self._bbox is None:
+            bbs = [bb for bb in (sh.bbox() for sh in self.canvas_shapes) if bb]
+            if not bbs:
+                return None
+            self._bbox = (min(bb[0] for bb in bbs), min(bb[1] for bb in bbs),
+                    max(bb[2] for bb in bbs), max(bb[3] for bb in bbs))
+        return self._bbox
+
+    def _defer(self, shape):
+        """Commit transformations of shape when Tk is idle"""
+        self._pending.add(shape)
+        if self._after is None:
+            if self.queue is None:
+                self._after = self.c.after_idle(self.commit)
+            else:
+                # commit just before the queue flush, so canvas is updated
+                # by one Tcl call per frame
+                self._after = self.queue.before_flush(self.commit)
+
+    def _cancel(self):
+        """Cancel scheduled commit()"""
+        if self._after is not None:
+            if self.queue is None:
+                self.c.after_cancel(self._after)
+            else:
+                self.queue.cancel_before(self._after)
+            self._after = None
+
+    def _getstore(self):
+        """Returns actual GeomStore of coordinates of all shapes or None
+        if it's not used. Coordinates of each shape become view of store
+        """
+        if not self.geomstore or geom.numpy is None:
+            return None
+        st = self._store
+        if st is None or len(st) != len(self.canvas_shapes) or \
+                any(sh.s.coords is not v for sh,v in itertools.izip(self.canvas_shapes, st.views)):
+            # new shapes or coordinates were replaced (points setting)
+            st = self._store = geom.GeomStore([sh.s.coords for sh in self.canvas_shapes])
+            for sh,v in itertools.izip(self.canvas_shapes, st.views):
+                sh.s.coords = v
+            self._storeindex = dict((sh, i) for i,sh in enumerate(self.canvas_shapes))
+        return st
+
+    def commit(self, shapes=None):
+        """Apply pending transformations of shapes (all if None) to canvas
+        (if queued, to the queue, see flush())
+        """
+        if shapes is None:
+            self._cancel()
+            shapes = self._pending
+            self._pending = set()
+        elif self._pending:
+            self._pending.difference_update(shapes)
+        st = self._getstore()
+        if st is not None:
+            # shapes with the same pending matrix are transformed at once
+            groups = {}
+            for sh in shapes:
+                if sh._m is not None:
+                    groups.setdefault(sh._m, []).append(sh)
+            for m, group in groups.iteritems():
+                if not geom.isidentity(m):
+                    if len(group) == len(st):
+                        st.apply(m)
+                    else:
+                        st.apply(m, [self._storeindex[sh] for sh in group])
+                for sh in group:
+                    sh._m = geom.IDENTITY # already applied, only canvas update
+        for sh in shapes:
+            sh.commit()
+
+    def flush(self):
+        """Commit all pending transformations and send queued updates
+        (if queued) to Tk now
+        """
+        self.commit()
+        if self.queue is not None:
+            self.queue.flush()
+        if self._raster is not None:
+            self._raster.flatten()
+
+    def _touched(self, shape):
+        """Shape will be changed by user, so flat shapes become canvas items
+        and placing of shape (see relayout()) starts from it's new geometry
+        """
+        self._layout.pop(shape, None)
+        if self._raster is not None:
+            self._raster.golive()
 
     def name_shapes(self, *names):
         """Name shapes, so each shape will have own name, and will be
@@ -675,7 +1539,10 @@ class GFigRender(GFigParser):
         This method is usable bcz gfig Gimp extension doesnot set name of
         shape.
         """
-        sorted_shapes = sorted(self.canvas_shapes, key=lambda sh:self.c.bbox(sh.tag)[:2])
+        self.commit()
+        # indexes of shapes sorted by location
+        sorted_indexes = sorted(xrange(len(self.canvas_shapes)),
+                key=lambda i:self.canvas_shapes[i].bbox()[:2])
         # names will be names and tail of "shNNN" for shapes without names
         d = len(self.canvas_shapes) - len(names)
         if d > 0:
@@ -684,8 +1551,8 @@ class GFigRender(GFigParser):
             for i in xrange(len(names), len(names)+d+1):
                 names.append("sh%d"%i)
         unsorted_names = [None]*len(self.canvas_shapes)
-        for name,sh in itertools.izip(names, sorted_shapes):
-            unsorted_names[self.canvas_shapes.index(sh)] = name
+        for name,i in itertools.izip(names, sorted_indexes):
+            unsorted_names[i] = name
         self.canvas_shapes.names = unsorted_names
 
     def shape(self, *names):
@@ -718,54 +1585,120 @@ class GFigRender(GFigParser):
 
     def delete(self):
         """Delete all corresponding items on canvas"""
+        self._cancel()
+        if self._resizeafter is not None:
+            self.c.after_cancel(self._resizeafter)
+            self._resizeafter = None
+        self._layout = {}
+        self._pending = set()
+        self._store = None
+        self._storeindex = {}
         for sh in self.canvas_shapes:
             try:
                 sh.delete()
             except:
                 pass
+        if self._raster is not None:
+            self._raster.clear()
+        self._bbox = None
+        self._grid = None
+        self._dirty = set()
+        self._optindex = None
+        self._optshapes = {}
+        self._optentries = {}
+        self._classindex = {}
+        self._noitem = set()
+        self._optdirty = set()
         self._placed_shapes = {}
         self.canvas_shapes = namedlist()
         #self.c.delete(self.name) # group - not need
 
-    def render(self, src):
+    def sethidden(self, hidden):
+        """Hide all shapes and their labels without deletion of canvas items
+        (if hidden), or show them in their own states (see
+        BaseCanvasShape.sethidden()). Flat shapes are hidden by their image
+        """
+        if self._raster is not None and not self._raster.live:
+            # hiding of recorded items would rasterize them again
+            for sh in self.canvas_shapes:
+                sh.hidden = hidden
+            self._raster.sethidden(hidden)
+            return
+        for sh in self.canvas_shapes:
+            sh.sethidden(hidden)
+
+    def render(self, src, select=None):
         """src is the file object. Caller have to close after rendering. Also
-        src may be string - file name"""
+        src may be string - file name. File is parsed line by line, so each
+        shape appears on canvas when it's read, not after whole file reading.
+        If there is cache, file (by name) is parsed only once.
+        src may be GFigIndex too, then only shapes with indexes select (all
+        if None) are materialized and rendered. Other shapes are not known
+        to GFigRender (find_shapes() etc. don't see them)"""
+        if isinstance(src, GFigIndex):
+            self.handle_header(src.header)
+            self.handle_options(src.options)
+            for sh in src.ishapes(select):
+                self.handle_shape(sh)
+            return
         if type(src) in (str, unicode):
-            with open(src, "rt") as f:
-                f.seek(0, os.SEEK_SET)
-                self.feed(f.read().decode(self.encoding))
+            if self.cache is not None:
+                header, options, shapes = self.cache.load(src, self.encoding)
+                self.handle_header(header)
+                self.handle_options(options)
+                for sh in shapes:
+                    self.handle_shape(sh.copy())
+                return
+            with open(src, "rb") as f:
+                self.parse(f, self.encoding)
         else:
             src.seek(0, os.SEEK_SET)
-            self.feed(src.read().decode(self.encoding))
+            self.parse(src, self.encoding)
 
     # Transformation methods {{{
 
     # NOTE transforms selected shapes or all
 
-    def move(self, xoff, yoff, shapes=None):
-        """Move to X-offset and Y-offset all items of this GFig
+    def transform(self, m, widthfactor=None, shapes=None):
+        """Transform by affine matrix m (see pybase.geom). If widthfactor,
+        then width of out-line will be scaled (minimal is 1 pixel)
         """
         if shapes is None:
             shapes = self.canvas_shapes
+        elif self._raster is not None:
+            # only some shapes are transformed
+            self._raster.golive()
         for sh in shapes:
-            sh.move(xoff, yoff)
+            # placing (see relayout()) starts from new geometry, like after
+            # _touched(), but flat shapes stay flat
+            self._layout.pop(sh, None)
+            sh._compose(m, widthfactor)
+        if self.deferred:
+            for sh in shapes:
+                self._defer(sh)
+        else:
+            self.commit(shapes)
+
+    def move(self, xoff, yoff, shapes=None):
+        """Move to X-offset and Y-offset all items of this GFig
+        """
+        self.transform(geom.translate(xoff, yoff), shapes=shapes)
 
     def flip(self, axe, axe_point, shapes=None):
         """Flip regarding axe 'x'|'y', axe_point - is coordinate
         of axe (need only one)
         """
-        if shapes is None:
-            shapes = self.canvas_shapes
-        for sh in shapes:
-            sh.flip(axe, axe_point)
+        if axe in ("x", "X"):
+            self.transform(geom.scale(1, -1, 0, axe_point), shapes=shapes)
+        elif axe in ("y", "Y"):
+            self.transform(geom.scale(-1, 1, axe_point, 0), shapes=shapes)
+        else:
+            raise ValueError(u"axe must be 'x' or 'y'")
 
     def rotate(self, x, y, angle, shapes=None):
         """Rotate about x,y with angle all items of this GFig
         """
-        if shapes is None:
-            shapes = self.canvas_shapes
-        for sh in shapes:
-            sh.rotate(x, y, angle)
+        self.transform(geom.rotate(angle, x, y), shapes=shapes)
 
     def xscale(self, factor, axe_point=0, widthscale=False, shapes=None):
         """Scale by factor by 0x, it's coords are specified by axe_point. If widthscale,
@@ -773,8 +1706,13 @@ class GFigRender(GFigParser):
         """
         if shapes is None:
             shapes = self.canvas_shapes
-        for sh in shapes:
-            sh.xscale(factor, axe_point, widthscale)
+        if axe_point in (LEFT, RIGHT):
+            # own axe_point of each shape
+            for sh in shapes:
+                sh.xscale(factor, axe_point, widthscale)
+        else:
+            self.transform(geom.scale(factor, 1, axe_point, 0),
+                    factor if widthscale else None, shapes)
 
     def yscale(self, factor, axe_point=0, widthscale=False, shapes=None):
         """Scale by factor by 0y, it's coords are specified by axe_point. If widthscale,
@@ -782,8 +1720,13 @@ class GFigRender(GFigParser):
         """
         if shapes is None:
             shapes = self.canvas_shapes
-        for sh in shapes:
-            sh.yscale(factor, axe_point, widthscale)
+        if axe_point in (TOP, BOTTOM):
+            # own axe_point of each shape
+            for sh in shapes:
+                sh.yscale(factor, axe_point, widthscale)
+        else:
+            self.transform(geom.scale(1, factor, 0, axe_point),
+                    factor if widthscale else None, shapes)
 
     # NOTE doesnot place on original place after forget, bcz no storage
     # of original shape points after it's transformation
@@ -792,6 +1735,7 @@ class GFigRender(GFigParser):
         But doesnot place on original place after forget!
         """
         for sh in shapes:
+            self._layout.pop(sh, None)
             try:
                 del self._placed_shapes[sh]
             except KeyError:
@@ -844,8 +1788,11 @@ class GFigRender(GFigParser):
             # needs dynamic placing of shapes if one or more are relative
             for sh in shapes:
                 self._placed_shapes[sh] = kw
-
-        if not delayed:
+                if sh in self._layout:
+                    self._layout[sh][1] = None # new args, so place again
+            if not delayed:
+                self.relayout(shapes=shapes)
+        elif not delayed:
             for sh in shapes:
                 sh.place(**kw)
 
@@ -854,19 +1801,56 @@ class GFigRender(GFigParser):
     def ifind_shapes(self, classname="any", name="any", **kw):
         """Generator: find all shapes by conditions: kw are itemcget() options,
         classname is the name of canvas shape class, name is the name of shape
-        (if has)
+        (if has). Options values are compared normalized, not exactly (see
+        normoption()): fill="RED" finds shapes with fill "red", width=2 -
+        with width "2.0". Shapes are found in the index of options set on
+        creation and by configure(), so Tk is called only for options unknown
+        for the shape (not set in such way, i.e. Tk defaults): once per shape
+        and search, so default values are always actual
         """
+        optindex = self._getoptindex()
+        found = None # None means all shapes
         if name != "any":
             try:
-                named_shape = self.canvas_shapes[name]
+                found = set([self.canvas_shapes[name]])
             except:
                 return
-
-        for sh in self.canvas_shapes:
-            if (classname=="any" or (sh.__class__.__name__==classname)) and \
-                    (name=="any" or sh is named_shape) and \
-                    all(sh.cget(k)==v for k,v in kw.iteritems()):
-                        yield sh
+        if classname != "any":
+            shapes = self._classindex.get(classname, set())
+            found = set(shapes) if found is None else found & shapes
+        for k,v in kw.iteritems():
+            v = normoption(v)
+            known = self._optshapes.get(k, set())
+            shapes = optindex.get((k, v), set())
+            # shapes which option is unknown are asked (Tk), shapes
+            # without canvas item have not options (like Tk returns "")
+            if found is None:
+                if len(known) + len(self._noitem) < len(self.canvas_shapes):
+                    unknown = (sh for sh in self.canvas_shapes
+                            if sh not in known and sh not in self._noitem)
+                else:
+                    unknown = ()
+                found = set(shapes)
+                if v == "":
+                    found.update(self._noitem.difference(known))
+            else:
+                unknown = found - known
+                found = found & shapes
+            for sh in unknown:
+                if sh.tag is None:
+                    cv = ""
+                else:
+                    cv = normoption(sh.cget(k))
+                if cv == v:
+                    found.add(sh)
+            if not found:
+                return
+        if found is None:
+            found = self.canvas_shapes
+        else:
+            found = sorted(found, key=lambda sh: self._optentries[sh][0])
+        for sh in found:
+            yield sh
 
     def find_shapes(self, **kw):
         """Similar to find_shapes() but returns list
@@ -877,10 +1861,8 @@ class GFigRender(GFigParser):
         """Find shapes in Z-order which contains x,y point: last is on the top.
         x,y are coordinates of canvas, not gfig file!
         """
-        for sh in self.canvas_shapes:
-            bx0,by0,bx1,by1 = self.c.bbox(sh.tag)
-            if bx0 <= x <= bx1 and by0 <= y <= by1:
-                yield sh
+        for sh in self._getgrid().find(x, y):
+            yield sh
 
     def find_shapes_at(self, x, y):
         """Similar to ifind_shapes_at() but returns list
@@ -905,13 +1887,41 @@ class GFigRender(GFigParser):
         class_ = globals().get(classname, CanvasIgnoredShape)
         # In the gfig file names often are equal, so use unique suffix
         grptag = u"%s_%d"%(self.name, id(self))
-        sh = class_(shape, grptag=grptag, canvas=self.c)
+        if self._raster is None:
+            sh = class_(shape, grptag=grptag, canvas=self.c)
+            sh.queue = self.queue
+        else:
+            sh = class_(shape, grptag=grptag, canvas=self._raster)
+        sh.touched = self._touched
+        if self.deferred:
+            sh.defer = self._defer
+        if self.lod:
+            sh.lod = (self.LODTOLERANCE, self.LODMINSIZE)
+        sh.bboxchanged = self._bboxchanged
+        sh.optionschanged = self._optionschanged
         sh.create()
+        self._grid = None # will be recreated with new shape
+        self._optindex = None
         self.canvas_shapes.append(sh)
     # }}}
 
 # }}}
 
+def gfig_image(src, encoding="utf8", ruby=False, bbox=None, cache=None):
+    """Returns RGBA Image (PIL) of GFig src (see GFigRender.render()) without
+    Tk: shapes are rendered on ImageCanvas (see pybase.tk.raster), labels are
+    not shown. If ruby, polygons are in ruby style. bbox is the area of image
+    in gfig coords (extent of shapes if None)
+    """
+    if raster is None:
+        raise ImportError(u"gfig_image() needs PIL")
+    c = raster.ImageCanvas()
+    r = GFigRender(c, encoding, cache=cache)
+    r.render(src)
+    if ruby:
+        r.configure(shapes=r.find_shapes(classname="CanvasPoly"), ruby=True)
+    return c.image(bbox)
+
 if __name__ == "__main__":
     import sys
     import doctest
@@ -0,0 +1,642 @@
+# Rasterization of canvas items (lines, ovals, rectangles, polygons, arcs)
+# with PIL. RasterCanvas is used by GFigRender instead of Tk canvas for static
+# layers: shapes items are only recorded and are shown as one image item on
+# the canvas (rasterized at the current scale). Image is cached in ImageCache
+# by digest of items (coords are relative to the image, so the same layers in
+# different places share one image). When shape is touched (configured,
+# transformed itself...), RasterCanvas goes live: creates real canvas items
+# instead of image and then only passes calls to canvas.
+# ImageCanvas is the headless canvas (without Tk): items are only recorded and
+# drawn to PIL image by image(). ThumbnailCache keeps thumbnails (PNG files)
+# by digest of contents of source files, for palettes and reports in batch jobs.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import collections
+import itertools
+import tempfile
+import hashlib
+import math
+import os
+from os import path
+from Tkinter import NW, HIDDEN, NORMAL, _flatten
+from PIL import Image, ImageDraw, ImageColor, ImageTk
+
+KINDS = ("line", "oval", "rectangle", "polygon", "arc") # rasterized items
+
+_colors = {} # {Tk color: RGBA}
+
+def tkcolor(color, canvas=None):
+    """Returns RGBA of Tk color or None if color is empty (transparent).
+    Colors unknown for PIL are asked canvas (Tk):
+    >>> tkcolor("#FF0000"), tkcolor("blue"), tkcolor("")
+    ((255, 0, 0, 255), (0, 0, 255, 255), None)
+    """
+    if not color:
+        return None
+    try:
+        return _colors[color]
+    except KeyError:
+        pass
+    try:
+        rgba = ImageColor.getrgb(color)
+    except ValueError:
+        if canvas is None:
+            raise
+        rgba = tuple(c >> 8 for c in canvas.winfo_rgb(color))
+    if len(rgba) == 3:
+        rgba += (255,)
+    _colors[color] = rgba
+    return rgba
+
+def _box(coords):
+    x0, y0, x1, y1 = coords[:4]
+    return (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+def _width(options):
+    try:
+        return max(1, int(round(float(options.get("width", 1)))))
+    except (TypeError, ValueError):
+        return 1
+
+def extent(items):
+    """Returns bbox (x0, y0, x1, y1) of items (kind, coords, options)
+    with their out-lines or None if there are not items
+    """
+    ret = None
+    for kind, coords, options in items:
+        if len(coords) < 2:
+            continue
+        m = int(math.ceil(_width(options)/2.)) + 1
+        xs = coords[0::2]
+        ys = coords[1::2]
+        bb = (int(math.floor(min(xs))) - m, int(math.floor(min(ys))) - m,
+                int(math.ceil(max(xs))) + m, int(math.ceil(max(ys))) + m)
+        if ret is None:
+            ret = bb
+        else:
+            ret = (min(ret[0], bb[0]), min(ret[1], bb[1]), max(ret[2], bb[2]), max(ret[3], bb[3]))
+    return ret
+
+def draw_item(draw, kind, coords, options, canvas=None):
+    """Draw canvas item on PIL ImageDraw draw like Tk does it (approximately:
+    without smoothing, dashes, stipples...)
+    """
+    color = lambda opt, default: tkcolor(options.get(opt, default), canvas)
+    w = _width(options)
+    if kind == "line":
+        fill = color("fill", "black")
+        if fill and len(coords) >= 4:
+            draw.line(list(coords), fill=fill, width=w)
+    elif kind in ("oval", "rectangle"):
+        fill = color("fill", "")
+        outline = color("outline", "black")
+        f = draw.ellipse if kind == "oval" else draw.rectangle
+        f(_box(coords), fill=fill, outline=outline, width=w if outline else 0)
+    elif kind == "polygon":
+        fill = color("fill", "black")
+        outline = color("outline", "")
+        it = iter(coords)
+        points = list(itertools.izip(it, it))
+        if len(points) < 2:
+            return
+        if fill:
+            draw.polygon(points, fill=fill)
+        if outline:
+            draw.line(points + points[:1], fill=outline, width=w)
+    elif kind == "arc":
+        # Tk angles are counter-clockwise, PIL - clockwise
+        start = float(options.get("start", 0))
+        extent = float(options.get("extent", 90))
+        a0, a1 = -(start + extent), -start
+        if extent < 0:
+            a0, a1 = a1, a0
+        # whole degrees: some PIL versions crash on fractional angles
+        # with wide out-line
+        a0, a1 = int(round(a0)), int(round(a1))
+        fill = color("fill", "")
+        outline = color("outline", "black")
+        style = options.get("style", "pieslice")
+        box = _box(coords)
+        if style != "arc" and fill:
+            f = draw.chord if style == "chord" else draw.pieslice
+            f(box, a0, a1, fill=fill)
+        if outline:
+            # out-line by lines: wide out-line of PIL pieslice is filled
+            draw.arc(box, a0, a1, fill=outline, width=w)
+            if style != "arc":
+                cx, cy = (box[0] + box[2])/2., (box[1] + box[3])/2.
+                rx, ry = (box[2] - box[0])/2., (box[3] - box[1])/2.
+                p0, p1 = [(cx + rx*math.cos(math.radians(a)), cy + ry*math.sin(math.radians(a)))
+                        for a in (a0, a1)]
+                draw.line([p0, (cx, cy), p1] if style != "chord" else [p0, p1],
+                        fill=outline, width=w)
+    else:
+        raise ValueError(u"can not rasterize '%s' item"%kind)
+
+def rasterize(items, bbox, canvas=None):
+    """Returns RGBA Image (transparent) with items (kind, coords, options)
+    drawn in bbox (x0, y0, x1, y1) - canvas coords of image
+    """
+    x0, y0, x1, y1 = bbox
+    im = Image.new("RGBA", (max(1, x1 - x0), max(1, y1 - y0)), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(im)
+    for kind, coords, options in items:
+        if options.get("state") == "hidden":
+            continue
+        coords = [c - (y0 if i%2 else x0) for i,c in enumerate(coords)]
+        draw_item(draw, kind, coords, options, canvas)
+    return im
+
+def digest(items, x0=0, y0=0):
+    """Digest of items (kind, coords, options), coords are relative
+    to x0, y0
+    """
+    h = hashlib.md5()
+    for kind, coords, options in items:
+        rel = tuple(round(c - (y0 if i%2 else x0), 1) for i,c in enumerate(coords))
+        opts = sorted((k, round(v, 1) if isinstance(v, float) else v)
+                for k,v in options.iteritems())
+        h.update(repr((kind, rel, opts)))
+    return h.hexdigest()
+
+class ImageCache:
+    """LRU cache of images (PhotoImage, PIL Image...)
+    >>> ic = ImageCache(2)
+    >>> ic.put("a", 1); ic.put("b", 2); ic.get("a"); ic.put("c", 3)
+    1
+    >>> ic.get("b"), ic.get("a"), len(ic)
+    (None, 1, 2)
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._images = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, key):
+        im = self._images.pop(key, None)
+        if im is not None:
+            self._images[key] = im
+        return im
+
+    def put(self, key, im):
+        self._images.pop(key, None)
+        self._images[key] = im
+        while len(self._images) > self.maxsize:
+            self._images.popitem(last=False)
+
+    def clear(self):
+        self._images.clear()
+
+shared_images = ImageCache()
+
+class ThumbnailCache:
+    """Content-addressed cache of thumbnails: PNG files in cachedir, named
+    by digest of source files contents and parameters of thumbnail. So
+    copied symbols share thumbnail and changed file gets new one (old files
+    are never removed, clear() them)
+    """
+    EXT = ".png"
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+    @staticmethod
+    def key(filenames, *params):
+        """Digest of contents of files filenames and params"""
+        h = hashlib.md5()
+        for fn in filenames:
+            fh = hashlib.md5()
+            with open(fn, "rb") as f:
+                for block in iter(lambda: f.read(65536), ""):
+                    fh.update(block)
+            h.update(fh.digest())
+        h.update(repr(params))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return path.join(self.cachedir, key + self.EXT)
+
+    def get(self, key):
+        """Returns Image or None"""
+        try:
+            im = Image.open(self._path(key))
+            im.load()
+            return im
+        except IOError:
+            return None
+
+    def put(self, key, im):
+        if not path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+        p = self._path(key)
+        # via temp. file, so other processes never see not finished file
+        fd, tmp = tempfile.mkstemp(dir=self.cachedir)
+        with os.fdopen(fd, "wb") as f:
+            im.save(f, "PNG")
+        if path.exists(p):
+            os.remove(p) # rename() on Windows can not replace
+        os.rename(tmp, p)
+
+    def clear(self):
+        if path.exists(self.cachedir):
+            for fname in os.listdir(self.cachedir):
+                if fname.endswith(self.EXT):
+                    os.remove(path.join(self.cachedir, fname))
+
+    def thumbnail(self, filenames, make, size=(64, 64), *params):
+        """Returns thumbnail (Image not bigger than size, with the same
+        aspect ratio) of image of files filenames: from cache or image is
+        made by make() then is cached. params are other parameters of image
+        (make() arguments)
+        """
+        key = self.key(filenames, tuple(size), *params)
+        im = self.get(key)
+        if im is None:
+            im = make()
+            im.thumbnail(size, Image.ANTIALIAS)
+            self.put(key, im)
+        return im
+
+# ImageCanvas, RasterCanvas {{{
+
+class ImageCanvas:
+    """Headless canvas-like object: items are only recorded (with options
+    and tags, like Tk keeps them) and image() draws them with PIL, so shapes
+    of GFigRender can be rendered without Tk (see gfig_image() in
+    pybase.tk.gfig). Text and image items are recorded but not drawn. Idle
+    callbacks (after(), after_idle()) are called by update_idletasks():
+    >>> c = ImageCanvas(20, 20)
+    >>> id = c.create_rectangle(2, 2, 10, 10, fill="red", tags="a")
+    >>> c.itemcget(id, "fill"), c.coords("a"), c.gettags(id)
+    ('red', [2, 2, 10, 10], ('a',))
+    >>> c.image().getpixel((5, 5)), c.image().getpixel((15, 15))
+    ((255, 0, 0, 255), (0, 0, 0, 0))
+    """
+    def __init__(self, width=0, height=0):
+        """width, height is the size of image (extent of items if 0)"""
+        self.width = width
+        self.height = height
+        self._items = collections.OrderedDict() # {id: [kind, coords, options, tags]}
+        self._newid = itertools.count(1).next
+        self._idle = collections.OrderedDict() # {after id: (func, args)}
+        self._newafter = itertools.count(1).next
+
+    def _changed(self):
+        """Is called when recorded items are changed"""
+        pass
+
+    # Items methods {{{
+
+    def _create(self, kind, *coords, **options):
+        id = self._newid()
+        tags = options.pop("tags", ())
+        if isinstance(tags, basestring):
+            tags = tags.split()
+        self._items[id] = [kind, list(_flatten(coords)), options, list(tags)]
+        self._changed()
+        return id
+
+    def create_line(self, *coords, **options):
+        return self._create("line", *coords, **options)
+
+    def create_oval(self, *coords, **options):
+        return self._create("oval", *coords, **options)
+
+    def create_rectangle(self, *coords, **options):
+        return self._create("rectangle", *coords, **options)
+
+    def create_polygon(self, *coords, **options):
+        return self._create("polygon", *coords, **options)
+
+    def create_arc(self, *coords, **options):
+        return self._create("arc", *coords, **options)
+
+    def create_text(self, *coords, **options):
+        return self._create("text", *coords, **options)
+
+    def create_image(self, *coords, **options):
+        return self._create("image", *coords, **options)
+
+    def _ids(self, tag):
+        """ids of recorded items with tag (id, tag or 'all')"""
+        if isinstance(tag, (int, long)):
+            return [tag] if tag in self._items else []
+        if tag == "all":
+            return list(self._items)
+        return [id for id,it in self._items.iteritems() if tag in it[3]]
+
+    def coords(self, tag, *coords):
+        ids = self._ids(tag)
+        if not coords:
+            return list(self._items[ids[0]][1]) if ids else []
+        if ids:
+            self._items[ids[0]][1] = list(_flatten(coords))
+            self._changed()
+
+    def itemconfigure(self, tag, cnf=None, **kw):
+        if cnf:
+            kw.update(cnf)
+        ids = self._ids(tag)
+        if not kw:
+            if not ids:
+                return None
+            item = self._items[ids[0]]
+            ret = dict((k, (k, "", "", "", v)) for k,v in item[2].iteritems())
+            ret["tags"] = ("tags", "", "", "", " ".join(item[3]))
+            return ret
+        tags = kw.pop("tags", None)
+        for id in ids:
+            item = self._items[id]
+            if tags is not None:
+                item[3] = list(tags.split() if isinstance(tags, basestring) else tags)
+            item[2].update(kw)
+        if ids:
+            self._changed()
+    itemconfig = itemconfigure
+
+    def itemcget(self, tag, option):
+        ids = self._ids(tag)
+        if not ids:
+            return ""
+        item = self._items[ids[0]]
+        if option == "tags":
+            return " ".join(item[3])
+        return item[2].get(option, "")
+
+    def gettags(self, tag):
+        ids = self._ids(tag)
+        return tuple(self._items[ids[0]][3]) if ids else ()
+
+    def addtag_withtag(self, newtag, tag):
+        for id in self._ids(tag):
+            if newtag not in self._items[id][3]:
+                self._items[id][3].append(newtag)
+
+    def delete(self, *tags):
+        deleted = False
+        for tag in tags:
+            for id in self._ids(tag):
+                del self._items[id]
+                deleted = True
+        if deleted:
+            self._changed()
+
+    # }}}
+
+    # Tk services {{{
+
+    def winfo_width(self):
+        return self.width
+
+    def winfo_height(self):
+        return self.height
+
+    def after(self, ms, func=None, *args):
+        if func is None:
+            return None
+        id = "after#%d"%self._newafter()
+        self._idle[id] = (func, args)
+        return id
+
+    def after_idle(self, func, *args):
+        return self.after(0, func, *args)
+
+    def after_cancel(self, id):
+        self._idle.pop(id, None)
+
+    def update_idletasks(self):
+        """Call all pending callbacks of after(), after_idle()"""
+        while self._idle:
+            func, args = self._idle.popitem(last=False)[1]
+            func(*args)
+    update = update_idletasks
+
+    # }}}
+
+    def items(self):
+        """Recorded items which can be rasterized: list of (kind, coords,
+        options)
+        """
+        return [it[:3] for it in self._items.itervalues() if it[0] in KINDS]
+
+    def image(self, bbox=None):
+        """Returns RGBA Image with items in bbox (x0, y0, x1, y1), default
+        is (0, 0, width, height) or extent of items if size is not set.
+        Pending callbacks are called before
+        """
+        self.update_idletasks()
+        items = self.items()
+        if bbox is None:
+            if self.width and self.height:
+                bbox = (0, 0, self.width, self.height)
+            else:
+                bbox = extent(items) or (0, 0, 1, 1)
+        return rasterize(items, bbox)
+
+class RasterCanvas(ImageCanvas):
+    """Canvas-like object for shapes of static layer: items are recorded
+    and are shown on canvas as one image item (flatten() when Tk is idle
+    after changes). Other calls go to canvas. After golive() (when items
+    are touched) items are real canvas items and all calls go to canvas
+    (ids of items are mapped)
+    """
+    def __init__(self, canvas, cache=None):
+        """canvas is the Tk canvas, cache is the ImageCache of PhotoImage
+        (shared_images if None)
+        """
+        ImageCanvas.__init__(self)
+        self.canvas = canvas
+        self.cache = shared_images if cache is None else cache
+        self.live = False
+        self.hidden = False # image item (and items on golive()) is hidden
+        self.imageitem = None # id of image item on canvas
+        self._photo = None # it's PhotoImage
+        self._real = {} # {id: canvas item id} when live
+        self._after = None # id of after_idle() for flatten()
+
+    def __getattr__(self, atr):
+        return getattr(self.canvas, atr)
+
+    def _changed(self):
+        if self._after is None:
+            self._after = self.canvas.after_idle(self.flatten)
+
+    def _cancel(self):
+        if self._after is not None:
+            self.canvas.after_cancel(self._after)
+            self._after = None
+
+    def _delete_image(self):
+        if self.imageitem is not None:
+            self.canvas.delete(self.imageitem)
+            self.imageitem = None
+            self._photo = None
+
+    def _golive(self, tag):
+        """Goes live if tag is not id of item, returns live"""
+        if not self.live and not isinstance(tag, (int, long)):
+            self.golive()
+        return self.live
+
+    # Items methods {{{
+
+    def _create(self, kind, *coords, **options):
+        if not self.live and kind not in KINDS:
+            self.golive()
+        if not self.live:
+            return ImageCanvas._create(self, kind, *coords, **options)
+        id = self._newid()
+        self._real[id] = getattr(self.canvas, "create_" + kind)(*coords, **options)
+        return id
+
+    def coords(self, tag, *coords):
+        if self._golive(tag):
+            return self.canvas.coords(self._real.get(tag, tag), *coords)
+        return ImageCanvas.coords(self, tag, *coords)
+
+    def itemconfigure(self, tag, cnf=None, **kw):
+        if cnf:
+            kw.update(cnf)
+        if self._golive(tag):
+            return self.canvas.itemconfigure(self._real.get(tag, tag), **kw)
+        return ImageCanvas.itemconfigure(self, tag, **kw)
+    itemconfig = itemconfigure
+
+    def itemcget(self, tag, option):
+        if self._golive(tag):
+            return self.canvas.itemcget(self._real.get(tag, tag), option)
+        return ImageCanvas.itemcget(self, tag, option)
+
+    def gettags(self, tag):
+        if self._golive(tag):
+            return self.canvas.gettags(self._real.get(tag, tag))
+        return ImageCanvas.gettags(self, tag)
+
+    def addtag_withtag(self, newtag, tag):
+        if self._golive(tag):
+            self.canvas.addtag_withtag(newtag, self._real.get(tag, tag))
+            return
+        ImageCanvas.addtag_withtag(self, newtag, tag)
+        if self.imageitem is not None and tag in self._items:
+            self.canvas.addtag_withtag(newtag, self.imageitem)
+
+    def delete(self, *tags):
+        for tag in tags:
+            if self._golive(tag):
+                self.canvas.delete(self._real.pop(tag, tag))
+            else:
+                ImageCanvas.delete(self, tag)
+
+    # }}}
+
+    # Tk services are of canvas
+    def winfo_width(self):
+        return self.canvas.winfo_width()
+
+    def winfo_height(self):
+        return self.canvas.winfo_height()
+
+    def after(self, *args):
+        return self.canvas.after(*args)
+
+    def after_idle(self, *args):
+        return self.canvas.after_idle(*args)
+
+    def after_cancel(self, id):
+        self.canvas.after_cancel(id)
+
+    def update_idletasks(self):
+        self.canvas.update_idletasks()
+
+    def update(self):
+        self.canvas.update()
+
+    def flatten(self):
+        """Show recorded items as one image item on canvas now"""
+        self._cancel()
+        if self.live:
+            return
+        items = self.items()
+        bbox = extent(items)
+        if bbox is None:
+            self._delete_image()
+            return
+        x0, y0 = bbox[:2]
+        key = digest(items, x0, y0)
+        photo = self.cache.get(key)
+        if photo is None:
+            photo = ImageTk.PhotoImage(rasterize(items, bbox, self.canvas))
+            self.cache.put(key, photo)
+        if self.imageitem is None:
+            tags = []
+            for it in self._items.itervalues():
+                tags.extend(t for t in it[3] if t not in tags)
+            self.imageitem = self.canvas.create_image(x0, y0, image=photo, anchor=NW,
+                    tags=tuple(tags), state=HIDDEN if self.hidden else NORMAL)
+        else:
+            self.canvas.coords(self.imageitem, x0, y0)
+            if photo is not self._photo:
+                self.canvas.itemconfigure(self.imageitem, image=photo)
+        self._photo = photo
+
+    def golive(self):
+        """Replace image by real canvas items (in the same place of
+        display list), then all calls go to canvas
+        """
+        if self.live:
+            return
+        self._cancel()
+        self.live = True
+        imagetags = self.canvas.gettags(self.imageitem) if self.imageitem is not None else ()
+        newtag = "raster%d"%id(self)
+        for id_, (kind, coords, options, tags) in self._items.iteritems():
+            options = dict(options)
+            options["tags"] = tuple(tags) + tuple(t for t in imagetags if t not in tags) + (newtag,)
+            if self.hidden:
+                options["state"] = HIDDEN
+            self._real[id_] = getattr(self.canvas, "create_" + kind)(*coords, **options)
+        if self.imageitem is not None and self._real:
+            self.canvas.tag_raise(newtag, self.imageitem)
+        self.canvas.dtag(newtag)
+        self._delete_image()
+        self._items.clear()
+
+    def sethidden(self, hidden):
+        """Hide image item without deletion (if hidden) or show it. Recorded
+        items are not changed, but they are created hidden by golive() while
+        hidden (owner shows them then)
+        """
+        self.hidden = hidden
+        if self.imageitem is not None:
+            self.canvas.itemconfigure(self.imageitem, state=HIDDEN if hidden else NORMAL)
+
+    def clear(self):
+        """Forget all (items must be deleted already), not live again"""
+        self._cancel()
+        self._delete_image()
+        self._items.clear()
+        self._real.clear()
+        self.live = False
+        self.hidden = False
+
+# }}}
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+    print "Internal tests passed"
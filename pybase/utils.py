@@ -369,25 +369,61 @@ class namedlist(list):
     Traceback (most recent call last):
         ...
     AttributeError: 'namedlist' object has no attribute 'x'
+    >>> nl[1:], nl.names
+    ([2, 3], ('first', 'second'))
+
+    Names are positional (name of index), so they are not changed
+    when items are changed. Lookup by name is O(1).
     """
     def __init__(self, items=None):
         super(namedlist, self).__init__(items or [])
-        self.names = []
+        self.names = ()
+
+    def _getnames(self):
+        return self._names
+
+    def _setnames(self, names):
+        self._names = tuple(names)
+        # {name: index}, first of the same names wins (like list.index())
+        self._nameindex = {}
+        for i,n in enumerate(self._names):
+            self._nameindex.setdefault(n, i)
+
+    names = property(_getnames, _setnames)
 
     def __getattr__(self, atr):
-        try:
-            i = self.names.index(atr)
-            return super(namedlist, self).__getitem__(i)
-        except:
+        i = self.__dict__.get("_nameindex", {}).get(atr)
+        if i is None or i >= len(self):
             raise AttributeError(u"'namedlist' object has no attribute '%s'"%atr)
+        return super(namedlist, self).__getitem__(i)
 
     def __getitem__(self, i):
-        try:
-            if not isinstance(i, int):
-                i = self.names.index(i)
-            return super(namedlist, self).__getitem__(i)
-        except:
-            raise IndexError("namedlist index out of range")
+        if not isinstance(i, (int, long, slice)):
+            try:
+                i = self._nameindex[i]
+            except (KeyError, TypeError):
+                raise IndexError("namedlist index out of range")
+        return super(namedlist, self).__getitem__(i)
+
+def _bench_namedlist(sizes=(1000, 10000), repeat=3):
+    """Lookup of all items by names: namedlist vs. names.index()"""
+    for size in sizes:
+        nl = namedlist(range(size))
+        nl.names = ["sh%d"%i for i in xrange(size)]
+        names = list(nl.names)
+        lookups = names[::max(1, size//1000)]
+        def best(f):
+            ret = None
+            for i in xrange(repeat):
+                t0 = time.time()
+                f()
+                t = time.time() - t0
+                ret = t if ret is None else min(ret, t)
+            return ret
+        t1 = best(lambda: [list.__getitem__(nl, names.index(n)) for n in lookups])
+        t2 = best(lambda: [nl[n] for n in lookups])
+        print "%6d items: index() %8.3f us, namedlist %8.3f us per lookup (%.0fx)"%(
+                size, t1*1e6/len(lookups), t2*1e6/len(lookups), t1/t2)
 
 # TODO never tested
 def modpath(modfile):
@@ -643,6 +679,8 @@ def recvall(sock, timeout=None):
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
+    if sys.argv[1:] == ["--bench"]:
+        _bench_namedlist()
     #s = IndentedString("   asd", 3)
     #print s.sp, s.ts, s
     #for l,t in indentlines("""